@@ -41,6 +41,7 @@ to add ignore the _BIN_EXTS below.
 from __future__ import print_function
 
 import multiprocessing
+import optparse
 import os
 import subprocess
 import sys
@@ -51,6 +52,10 @@ import sys
 import random
 import types
 import re
+import struct
+import heapq
+import Queue
+import zlib
 
 from array import array
 from collections import OrderedDict
@@ -58,6 +63,11 @@ from collections import OrderedDict
 
 sys.path.append(os.path.abspath(os.path.dirname(__file__)))
 from gitutils import *
+from caches import BoundedCache, PoolCacheStats, SharedMap
+from checkpoint import StateDir
+from pathmap import LoadPathRules
+from scheduler import RangePool
+from tracelog import TraceLog, TRACE_MODES, TRACE_OFF
 
 
 _SKIP_COPY_INTO_CGS = True
@@ -70,6 +80,17 @@ _BIN_EXTS = ({'.aif', '.bin', '.bmp', '.cur', '.gif', '.icm', '.ico', '.jpeg',
 
 _KILL_EXTS = ({'.msi'})
 
+# The phases which can be checkpointed with --state-dir, in order.
+_PHASES = ['collect', 'convert', 'trees']
+
+# Sizes of the checkpoint records: _CacheKey() and _CacheKey() + SHA1.
+_KEY_RECORD_SIZE = 24
+_MAP_RECORD_SIZE = 44
+_COMMIT_RECORD_SIZE = 84
+# One per parent (or a null one for roots) of the commits of _commit_graph:
+# _CacheKey() + generation ('>L') + parent.
+_GRAPH_RECORD_SIZE = 48
+
 class DIRS:
   # The .git/objects dir containing the original loose objects.
   ORIGOBJS = '/mnt/d_scratch/loose'  # Will be figured out at runtime using git --git-dir.
@@ -81,33 +102,165 @@ class DIRS:
   GCS = '/mnt/d_scratch/gcs-bucket/'
 
 
+# The maps below are shared by all the workers. They are SharedMap instances,
+# created by _CreateSharedMaps() before forking any pool, keyed by _CacheKey().
+
 # _tree_cache is a map of tree-ish -> translated tree-ish and is used to avoid
 # re-translating sub-trees which are identical between subsequent commits
-_tree_cache = multiprocessing.Manager().dict()
+_tree_cache = None
 
 # collected - trees already seen by _CollectTree
-_collected_tree = multiprocessing.Manager().dict()
+_collected_tree = None
 
-# A map of <original tree SHA1 (hex)> -> <translated SHA1> for top-level trees.
+# A map of <original tree SHA1> -> <translated SHA1> for top-level trees.
 # Contains the results of _TranslateOneTree calls.
-_root_trees = multiprocessing.Manager().dict()
+_root_trees = None
 
 # map for patched files
-_file_cache = multiprocessing.Manager().dict()
+_file_cache = None
+
+# A map of <original commit SHA1> -> <rewritten commit SHA1> + <its tree SHA1> +
+# <the original commit it was rewritten from>. Commits which were not written
+# (see _LinkCommit()) map to their nearest rewritten ancestor, or to
+# _NULL_COMMIT if they have none.
+_commit_map = None
+_NULL_COMMIT = '\x00' * 60
 
-# set of SHA1s (just to keep the total count)
-_gcs_blobs = multiprocessing.Manager().dict()
+# The original commits linked so far, by this run (see _RunPipeline()) or by the
+# previous ones (see _LoadRewrite()), as raw SHA1s.
+_linked_revs = set()
 
-_local_file_cache = {}
-_local_collected_cache = {}
-_local_tree_cache = {}
+# Per-worker caches in front of the shared maps above (BoundedCache instances,
+# see _CreateLocalCaches()).
+_local_file_cache = None
+_local_collected_cache = None
+_local_tree_cache = None
+
+# Number of worker processes (--jobs).
+_jobs = multiprocessing.cpu_count()
+
+# How the workers trace the entries of the trees they walk (--trace).
+_trace_mode = TRACE_OFF
+
+# The logs of this worker, by name (see _WorkerLog()).
+_worker_logs = {}
 
 mt_tree = OrderedDict({});
 
+# The parents and the generation (1 + the max generation of the parents) of
+# the rewritten commits, by _CacheKey(target, rewritten commit). Kept by the
+# parent process across the runs (see _LoadRewrite()), the workers of
+# _RewriteCommits() send back the nodes they add.
+_commit_graph = {}
+
 log = None
 
+def _WorkerLog(name):
+  """Returns the log/<name>-<pid>.log of this worker, opened on first use."""
+  log = _worker_logs.get(name)
+  # A forked worker inherits the logs of its parent, which aren't its own.
+  if log is None or log.pid != os.getpid():
+    log = TraceLog('log/%s-%d.log' % (name, os.getpid()), _trace_mode)
+    _worker_logs[name] = log
+    p = multiprocessing.current_process()
+    print('hello from process %s with pid %s' % (p.name, p.pid), file=log)
+  return log
+
+
+def _CreateSharedMaps(capacity):
+  global _tree_cache, _collected_tree, _root_trees, _file_cache, _commit_map
+  _tree_cache = SharedMap(capacity)
+  _collected_tree = SharedMap(capacity, value_size=1)
+  _root_trees = SharedMap(capacity)
+  _file_cache = SharedMap(capacity)
+  _commit_map = SharedMap(capacity, value_size=60)
+
+
+def _CreateLocalCaches(max_entries):
+  global _local_file_cache, _local_collected_cache, _local_tree_cache
+  _local_file_cache = BoundedCache('file', max_entries)
+  _local_collected_cache = BoundedCache('collected', max_entries)
+  _local_tree_cache = BoundedCache('tree', max_entries)
+
+
+def _NewPool(pool_class=multiprocessing.Pool):
+  """Returns a pool of _jobs workers, which report the stats of their caches.
+
+  pool_class is either multiprocessing.Pool or RangePool.
+  """
+  stats = PoolCacheStats(
+      [_local_file_cache, _local_collected_cache, _local_tree_cache])
+  pool = pool_class(_jobs, initializer=stats.InitWorker)
+  return pool, stats
+
+
+def _CacheKey(target, sha1_raw):
+  """Returns the fixed-width key of the object sha1_raw rewritten for target.
+
+  target can be either the target repo name or its objdir.
+  """
+  target_id = zlib.crc32(os.path.basename(target)) & 0xffffffff
+  return struct.pack('>L', target_id) + sha1_raw
+
+
+class _ShaArray(object):
+  """A compact list of SHA1s (e.g. the revs and trees of the rev-list).
+
+  The SHA1s are kept as a slab of 20-byte raw values, rather than one string
+  each, and read back as hex, so that it can stand in for a list of hex SHA1s:
+  it supports len(), indexing, slicing, iteration, index() and in.
+  """
+
+  def __init__(self, hexvalues=()):
+    self._data = bytearray()
+    for hexvalue in hexvalues:
+      self.append(hexvalue)
+
+  def append(self, hexvalue):
+    assert(len(hexvalue) == 40)
+    self._data += SHA1.HexToRaw(hexvalue)
+
+  def __len__(self):
+    return len(self._data) / 20
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      start, stop, step = i.indices(len(self))
+      assert(step == 1)
+      result = _ShaArray()
+      result._data = self._data[20 * start:20 * max(start, stop)]
+      return result
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError(i)
+    return SHA1.RawToHex(str(self._data[20 * i:20 * i + 20]))
+
+  def __iter__(self):
+    for i in xrange(len(self)):
+      yield self[i]
+
+  def index(self, hexvalue):
+    raw = SHA1.HexToRaw(hexvalue)
+    pos = self._data.find(raw)
+    # Skip the matches across two SHA1s.
+    while pos > 0 and pos % 20:
+      pos = self._data.find(raw, pos + 1)
+    if pos < 0:
+      raise ValueError('%s is not in the list' % hexvalue)
+    return pos / 20
+
+  def __contains__(self, hexvalue):
+    try:
+      self.index(hexvalue)
+    except ValueError:
+      return False
+    return True
+
+
 def _BuildGitignoreMaybeCached(base_sha1=None):
-  cache_key = base_sha1.raw if base_sha1 else 'blank'
+  cache_key = _CacheKey('.gitignore', base_sha1.raw if base_sha1 else
+                        '\x00' * 20)
   cached_gitignore = _tree_cache.get(cache_key)
   if cached_gitignore:
     return SHA1(cached_gitignore)
@@ -122,6 +275,11 @@ def _BuildGitignoreMaybeCached(base_sha1=None):
     return sha1
 
 
+# The bytes ignored by _GuessGitFileEnc() when counting.
+_ASCII_BYTES = ''.join(chr(i) for i in range(0x80))
+_BELOW_C0_BYTES = ''.join(chr(i) for i in range(0xC0))
+
+
 def _GuessGitFileEnc( sha1, buf, log ):
 
     ln = len(buf);
@@ -145,35 +303,35 @@ def _GuessGitFileEnc( sha1, buf, log ):
     if (buf[0:len(xml)] == xml):
       winxml = True ;
      
-    # histo 
-    readlen = min(8192, ln);  #to analyze
-      
-    histo = array('I', [0] * 256)
-    for i in range(0, readlen):
-      c = ord(buf[i]);
-      histo[ c ] = histo[ c ] + 1;
-    
-    total8bit = 0
-    for i in range(128,256):
-      total8bit = total8bit + histo[i];
+    # Only the 8-bit bytes matter: strip the others (at C speed) and count.
+    high = buf[:8192].translate(None, _ASCII_BYTES)
+    total8bit = len(high)
      
     if (total8bit == 0):
       return 'ASCII';
       
-    if (total8bit == (histo[0xA0] + histo[0x93] + histo[0x94])) and not winxml:
+    a0_93_94 = high.count('\xA0') + high.count('\x93') + high.count('\x94')
+    if (total8bit == a0_93_94) and not winxml:
       return 'WINDET';
       
-    d0d1 = histo[ 0xD0 ] + histo[ 0xD1 ];
-    utfd = float(d0d1) / float( total8bit - d0d1);
+    d0d1 = high.count('\xD0') + high.count('\xD1');
+    utfd = float(d0d1) / float(max(total8bit - d0d1, 1));
     if (d0d1 > 0) and ( utfd > 0.9) and not winxml:
       return 'UTFDET'; 
      
-    c0ff = 0
-    for i in range(0xC0, 0xFF+1):
-      c0ff = c0ff + histo[i];
+    c0ff = len(high.translate(None, _BELOW_C0_BYTES)) + a0_93_94
+
+    win = float(c0ff)/float(total8bit);
+    if ((win > 0.95) or winxml) and ('\x98' not in high):
+      return 'WINDET';
+
+    # Not detected: log the full histogram.
+    readlen = min(8192, ln);
+    histo = array('I', [0] * 256)
+    for i in range(0, readlen):
+      c = ord(buf[i]);
+      histo[ c ] = histo[ c ] + 1;
 
-    c0ff = c0ff + histo[0xA0] + histo[0x93] + histo[0x94];
-      
     dgtsnsyn = 0
     for i in range(32,64+1):
       dgtsnsyn = dgtsnsyn + histo[i];
@@ -182,10 +340,6 @@ def _GuessGitFileEnc( sha1, buf, log ):
     for i in range(123,126+1):
       dgtsnsyn = dgtsnsyn + histo[i];
 
-    win = float(c0ff)/float(total8bit);
-    if ((win > 0.95) or winxml) and (histo[0x98] == 0):
-      return 'WINDET';
-
     print('Histo:', file=log);
     for i in range(0,256):
       if (histo[i] > 0):
@@ -249,7 +403,8 @@ def _TreeAppend(tree, mode, file, sha1, log, path):
 
 def _MaterializeTree(tree, target, path, log):
   
-  entries = OrderedDict({})
+  # The names in tree are unique, no need for _TreeAppend() here.
+  entries = []
   for fname in sorted(tree):
     _mode, _fname, _sha1, _children = tree[fname]
     if (_sha1 is None):
@@ -261,11 +416,9 @@ def _MaterializeTree(tree, target, path, log):
       if len(_children) > 0:
         print("MATERR: contents in children+sha1 for %s/%s" % (path, _fname), file=log);
 
-    _TreeAppend( entries, _mode, _fname, _sha1, log, path )
+    entries.append( (_mode, _fname, _sha1) )
 
-  log.flush();
-  
-  res = WriteGitTree(entries.values(), target)
+  res = WriteGitTree(entries, target)
   return res;
 
 
@@ -288,8 +441,6 @@ def _RootMaterializeTree(tree, target, path, log):
 
     split_trees[_fname] = _sha1;
 
-  log.flush();
-
   return split_trees;
 
 
@@ -297,403 +448,20 @@ def _RootMaterializeTree(tree, target, path, log):
 MAP_UNKNOWN=('godeepr','');
 MAP_DROP=('drop','');
 
-def _TreePathMapping(indent, fname, path, log):
-
-  if (indent == 0):
-    if (fname == 'ruscorpora'):
-      return MAP_UNKNOWN;
-    else:
-      print("ERR: unknown L0 branch: %s/%s drop" % (path, fname), file=log);
-      return MAP_DROP;
-      
-  if (indent == 1):
-    if (fname == 'trunk'):
-      return MAP_UNKNOWN;
-    if (fname == 'branches'):
-      return MAP_DROP
-    
-  if (indent == 2):
-    if (fname == 'corpora'): #lexicografically first
-      return MAP_UNKNOWN;
-
-    elif (fname == 'www') or (fname == 'saas') or (fname == 'conf') or (fname == 'db') or (fname == 'hooks') or (fname == 'locks') or (fname == 'ruscorpora_suggest') or (fname == 'makeup') or (fname == 'tagged'):
-      return MAP_DROP;
-
-    elif (fname == 'README.txt') or (fname == 'format'):
-      return MAP_DROP;
-
-    elif (fname == 'accent'):
-      return ('accent', 'accent_main/texts');
-      
-    elif (fname == 'spoken') or (fname == 'tables'):
-      return (fname, '')
-    
-    elif (fname == 'research'):
-      return ('projects', '')
-      
-    elif (fname == 'standard') or (fname == 'source'):
-      return ('main', '')
-
-    elif (fname == 'texts'):
-      return MAP_UNKNOWN;
-    
+# The compiled rules of path_rules.json (or of --path-rules), see pathmap.py.
+_path_rules = None
 
-  _parent = os.path.split(path);
-  parent = _parent[1];
-  parentparent = os.path.split(_parent[0])[1];
-
-  if (indent == 3):
-    if (parent == 'corpora'):
-
-      if (fname == 'spoken'):
-        return MAP_UNKNOWN
-      if (fname == 'version'):
-        return MAP_DROP
-      if (fname == 'para_rus_ger'):
-        return MAP_DROP
-      if (fname == '18century') or (fname == 'folklore') or (fname == 'test_corpus') or (fname == 'research'):
-        return ('projects', '');
-      if (fname == 'slav'):
-        return MAP_UNKNOWN
-      else:
-        return (fname, '')  #... ,tables
-
-    if (parent == 'spoken'):
-      
-      if (fname == 'manual'):
-        return (parent, 'manual/texts')
-      elif (fname == 'private') or (fname == 'public'):
-        return (parent, 'texts/%s' % fname)
-      elif (fname == 'tabl_manual_spoken.csv'):
-        return (parent, 'manual/tables', 'manual.csv')
-      elif (fname == 'spoken.csv'):
-        return (parent, 'tables')
-      elif (fname == 'murco'):
-        return ('murco', '/');
-
-    if (parent == 'standard') or (parent == 'source'):
-      
-      if (fname == 'pre1950') or (fname == 'post1950'):
-        return ('main', '%s/texts/%s' % (parent, fname))
-      elif (fname == 'standard_1.csv'):
-        return ('main', '%s/tables' % parent, 'standard.csv');
-      
-    if (parent == 'texts'):
-      
-      if (fname == 'source') or (fname == 'standard'):
-        return ('main', '%s/texts' % fname);
-      elif (fname == 'accent'):
-        return ('accent', '')
-      elif (fname == 'school') or (fname == 'syntax'):
-        return (fname, 'texts')
-      elif (fname == 'dialect') or (fname == 'spoken') or (fname == 'murco') or (fname == 'poetic') or (fname == 'para') or (fname == 'paper'):
-        return (fname, '')
-
-    if (parent == 'research'):
-      return ('projects', '%s/%s' % (parent, fname));
-
-    if (parent == 'tables'):
-      return (parent, '/');
-
-
-  if (indent == 4):
-    if (parent == 'dialect'):
-      if (fname == 'texts') or (fname == 'tables'):
-        return (parent, fname)
-      elif (fname == 'dialect.csv'):
-        return (parent, 'tables')
-  
-    if (parent == 'spoken'):
-
-      if (fname == 'private') or (fname == 'public'):
-        return (parent, 'texts/%s' % fname)
-      elif (fname == 'tabl_manual_spoken.csv'):
-        return (parent, 'manual/tables', 'manual.csv')
-      elif (fname == 'spoken.csv'):
-        return (parent, 'tables')
-      elif (fname == 'tables') or (fname == 'texts') or (fname == 'manual') or (fname == 'murco') or (fname == 'accent'):
-        return (parent, '')
-
-    if (parent == 'murco'):
-      if (fname == 'kino'):
-        return (parent, '');
-      if (fname == 'private') or (fname == 'public'):
-        return (parent, 'texts/%s' % fname )
-      elif (fname == 'murco.csv') or (fname == 'video_ids.txt'):
-        return (parent, 'tables');
-      elif (fname == 'texts') or (fname == 'tables') or (fname == 'meta'):
-        return (parent, fname)    
-  
-    if (parent == 'poetic'):
-      if (fname == 'xix') or (fname == 'xviii') or (fname == 'xx'):
-        return (parent, 'texts/%s' % fname );
-      elif (fname == 'poetic.csv'):
-        return (parent, 'tables');
-      elif (fname == 'texts'):
-        return (parent, '')    
-      elif (fname == 'tables'):
-        return (parent, fname);
-      
-    if (parent == 'main'):
-      if (fname == 'source') or (fname == 'standard'):
-        return (parent, fname)
-  
-    if (parent == 'para'):
-      if (fname == 'texts') or (fname == 'tables'):
-        return (parent, '')
-      if (fname == 'para.csv'):
-        return (parent, 'tables');
-      if (fname[0:3] == 'rus') or (fname[-3:] == 'rus'):
-        return (parent, 'texts/%s' % fname )  
-  
-  
-    if (parent == 'accent'):
-      if (fname == 'texts') or (fname == 'tables'):
-        return (parent, 'accent_main/%s' % fname);
-      elif (fname == 'accent.csv'):
-        return (parent, 'accent_main/tables');
-      elif (fname == 'public') or (fname == 'private') or (fname == 'kino'):
-        return (parent, 'accent_main/texts/%s' % fname);
-      else:
-        return (parent, fname);
-  
-    if (path == '/ruscorpora/trunk/corpora/tables'):
-      if (fname == 'validation'):
-        return ('tables', fname);
-      else:
-        return ('tables', '/');
-  
-    if (path == '/ruscorpora/trunk/texts/paper'):
-      if (fname == 'RIAN'):
-        return (parent, 'texts/%s' % fname.lower());
-      elif (fname == 'paper.csv'):
-        return (parent, 'tables');
-      else:
-        return (parent, 'texts/%s' % fname);
-  
-    if (path == '/ruscorpora/trunk/corpora/paper'):
-      if (fname == 'README.txt') or (fname =='Desktop.ini') or (fname == 'conf') or (fname == 'db') or (fname == 'format') or (fname == 'hooks') or (fname =='locks') or (fname == 'svn.ico'):
-        return MAP_DROP
-    
-  
-    if (parent == 'regional_grodno') or (parent == 'multiparc'):
-      if fname[-3:] == 'xls':
-        return (parent, '/');
-      else:
-        return (parent, fname);
-      
-    if (parent == 'slav'):
-      if (fname == 'texts') or (fname == 'tables') or (fname == 'old_slav'):
-        return MAP_UNKNOWN
-      elif (fname == 'orthlib') or (fname == 'birchbark') or (fname == 'mid_rus') or (fname == 'old_rus'):
-        return (fname, '');
-      elif (fname == 'mid_rus_new'):
-        return ('mid_rus', '');
-      elif (fname == 'txt-renamer.py'):
-        return MAP_DROP; 
-      elif (re.search(r'_akty_.*txt', fname)):
-        return ('mid_rus', 'texts/gramoty_akty_14_16');
-      elif (fname == 'Летописец начала царства-out.txt'):
-        return ('mid_rus', 'texts/letopisets', 'Letopisets-out.txt');
-      elif (fname == 'meta.xls'):
-        return ('mid_rus', fname);
-      else:
-        return ('mid_rus', '');
-      
-    if (parent == 'test_corpus'):
-      if (fname == 'README'):
-        return ('projects', parent);
-      else:
-        return ('projects', '%s/%s' % (parent, fname));
-
-    if (parent == '18century'):
-      if (fname == 'table') or (fname == 'tables'):
-        return ('projects', '%s/tables' % parent);
-      elif (fname == 'texts'):
-        return ('projects', '%s/%s' % (parent, fname));
-
-    if (parent == 'folklore'):
-      return ('projects', '%s/%s' % (parent, fname));
-
-    if (parent == 'research'):
-      return ('projects', '%s/%s' % (parent, fname));
-  
-    # any parent        
-    if (fname == 'texts') or (fname == 'tables'):
-      return (parent, fname)    
-  
-  if indent==5:
-    if (path == '/ruscorpora/trunk/corpora/para/texts') or (path == '/ruscorpora/trunk/corpora/para/tables'):
-      if (fname[0:3] == 'rus') or (fname[-3:] == 'rus') or (fname == 'multi'):
-        return ('para', 'texts/%s' % (fname))
-      if (fname[-3:] == 'csv'):
-        return ('para', 'tables')
-      if (fname[-4:] == 'djvu'):
-        return ('para', 'tables')
-        
-    if (path == '/ruscorpora/trunk/corpora/murco/kino') or (path == '/ruscorpora/trunk/texts/murco/kino'):
-      return ('murco', 'kino/%s' % fname.lower());
-      
-    if (path == '/ruscorpora/trunk/corpora/poetic/texts'):
-      if (fname == 'poetic'):
-        return (fname, '');
-      else:
-        return ('poetic', 'texts/%s' % fname);
-      
-    if (path == '/ruscorpora/trunk/corpora/spoken/texts'):
-      if (fname == 'manual'):
-        return ('spoken', 'manual/texts');
-      elif (fname == 'spoken.csv'):
-        return ('spoken', 'tables')
-      elif (fname == 'tabl_manual_spoken.csv'):
-        return ('spoken', 'manual/tables', 'manual.csv');
-      else:
-        return ('spoken', 'texts/%s' % fname);
-      
-    if (path == '/ruscorpora/trunk/corpora/spoken/manual') or (path == '/ruscorpora/trunk/texts/spoken/manual'):
-      if (fname == 'texts'):
-        return ('spoken', 'manual/texts');
-      elif (fname == 'tables'):
-        return ('spoken', '');
-      else:
-        return ('spoken', 'manual/texts/%s' % fname);  # ruscorpora/trunk/corpora/spoken/manual/kino/beloe_solnce.acc.xh
-
-    if (path == '/ruscorpora/trunk/corpora/spoken/tables'):
-      if (fname == 'tabl_manual_spoken.csv'):
-        return ('spoken', 'manual/tables', 'manual.csv');
-      elif (fname == 'spoken.csv'):
-        return ('spoken', 'tables');
-      else:
-        return ('spoken', 'tables');
-
-    if (path == '/ruscorpora/trunk/corpora/spoken/murco'):
-      return ('murco', fname);
-    if (path == '/ruscorpora/trunk/corpora/spoken/accent'):
-      return ('accent', fname);
-
-    if (parentparent == 'slav'):
-      if (parent == 'mosk_del_byt_pism-1') or (parent == 'pskov_letopisi') or (parent == 'morozov') or (parent == 'jaroslav_etc') or (parent == 'gramoty_akty_14_16') or (parent == 'gramotki_17_18') or (parent == 'duhovnye_dogovornye') or (parent == 'BDRL') or (parent == 'letopisets'):
-        return ('mid_rus', 'texts/%s' % parent )
-      elif (parent == 'Грамотки 17 - нач. 18 вв'):
-        return ('mid_rus', 'texts/gramotki_17_18')
-      elif (parent == 'Духовные и договорные грамоты'):
-        return ('mid_rus', 'texts/duhovnye_dogovornye')
-      elif (parent == 'Моск. дел. и быт. письм. Отд. 1'):
-        return ('mid_rus', 'texts/mosk_del_byt_pism-1')
-
-
-    if (path == '/ruscorpora/trunk/corpora/slav/texts'):
-      if (fname == 'orthlib'):
-        return ('orthlib', 'texts')
-      if (fname == 'old_slav'):
-        return ('old_rus', 'texts')
-      if (fname == 'melissa') or (fname == 'npl'):
-        return ('old_rus', 'texts/%s' % fname )
-
-    if (path == '/ruscorpora/trunk/corpora/slav/tables'):
-      if (fname == 'slav.csv') or (fname == 'old_slav.csv'):
-        return ('old_rus', 'tables', 'old_rus.csv')
-      if (fname == 'orthlib.csv'):
-        return ('orthlib', 'tables')
-
-    if (path == '/ruscorpora/trunk/corpora/slav/old_slav'):
-      if (fname == 'texts'):
-        return MAP_UNKNOWN;
-      if (fname == 'tables'):
-        return ('old_rus', '');
-
-    if (path == '/ruscorpora/trunk/corpora/slav/old_rus'):
-      if (fname == 'texts'):
-        return ('old_rus', fname);
-      if (fname == 'tables'):
-        return ('old_rus', '');
-        
-    if (path == '/ruscorpora/trunk/corpora/slav/orthlib'):
-      if (fname == 'texts') or (fname == 'tables') or (fname == 'textss'):
-        return ('orthlib', fname);
-        
-    if (path == '/ruscorpora/trunk/corpora/slav/birchbark'):
-      if (fname == 'texts') or (fname == 'tables'):
-        return ('birchbark', fname);
-
-    if (path == '/ruscorpora/trunk/corpora/slav/mid_rus'):
-      if (fname == 'mosk_del_byt_pism-1') or (fname == 'pskov_letopisi') or (fname == 'morozov') or (fname == 'jaroslav_etc') or (fname == 'gramoty_akty_14_16') or (fname == 'gramotki_17_18') or (fname == 'duhovnye_dogovornye') or (fname == 'BDRL') or (fname == 'letopisets'):
-        return ('mid_rus', 'texts/%s' % fname.lower());
-      if (fname == 'texts'):
-        return ('mid_rus', '');
-      if (fname == 'tables'):
-        return ('mid_rus', '');
-      
-    if (path == '/ruscorpora/trunk/corpora/slav/mid_rus_new'):
-      if (fname == 'texts') or (fname == 'tables'):
-        return ('mid_rus', '');
-      if (fname == 'mosk_del_byt_pism-1') or (fname == 'pskov_letopisi') or (fname == 'morozov') or (fname == 'jaroslav_etc') or (fname == 'gramoty_akty_14_16') or (fname == 'gramotki_17_18') or (fname == 'duhovnye_dogovornye') or (fname == 'BDRL') or (fname == 'letopisets') or (fname == 'polotsk'):
-        return ('mid_rus', 'texts/%s' % fname.lower());
-      if (fname == 'afz1') or (fname == 'afz2') or (fname == 'afz3') or (fname == 'amg') or (fname == 'apd') or (fname == 'bdrl') or (fname == 'drama') or (fname == 'gvnp') or (fname == 'kungur') or (fname == 'letopisi_varia') or (fname == 'nkl') or (fname == 'pososhkov') or (fname == 'psrl34') or (fname == 'rd') or (fname == 'rib') or (fname == 'st_kn') or (fname == 'statspis') or (fname == 'varia') or (fname == 'varia2') or (fname == 'zagovor') or (fname == 'lebedev'):
-        return ('mid_rus', 'texts/%s' % fname.lower());
-      if (fname == 'GramEval2020-17cent-test.RNC.nolemma.xml'):
-        return MAP_DROP 
-      
-  if (indent==6):
-    if (path == '/ruscorpora/trunk/corpora/poetic/texts/poetic'):
-      if (fname == 'poetic.csv'):
-        return ('poetic', 'tables');
-      else:
-        return ('poetic', 'texts/%s' % fname);
-
-    if (path == '/ruscorpora/trunk/corpora/spoken/manual/tables'):
-      if (fname == 'spoken_manual.csv'):
-        return ('spoken', 'manual/tables', 'manual.csv');
-      else:
-        return ('spoken', 'manual/tables');
-
-    if (path == '/ruscorpora/trunk/corpora/slav/old_slav/tables') or (path == '/ruscorpora/trunk/corpora/slav/old_rus/tables'):
-      if (fname == 'old_slav.csv') or (fname == 'old_rus.csv'):
-        return ('old_rus', 'tables', 'old_rus.csv');
-      
-    if (path == '/ruscorpora/trunk/corpora/slav/old_slav/texts'):
-      if (fname == 'birchbark'):
-        return ('birchbark', 'texts');
-      else:
-        return ('old_rus', 'texts/%s' % fname);
-        
-      if (fname == 'npl') or (fname == 'melissa') or (fname == 'nikola') or (fname == 'galician') or (fname == 'volhynian'):
-        return ('old_rus', 'texts/%s' % (fname));
-        
-    if (path == '/ruscorpora/trunk/corpora/slav/mid_rus/texts'):
-      if (fname[-3:] == 'xml'):
-        return ('mid_rus', 'texts/varia2');
-      else:
-        return ('mid_rus', 'texts/%s' % fname.lower()); #fix BDRL
-
-    if (path == '/ruscorpora/trunk/corpora/slav/mid_rus/tables'):
-      if (fname == 'meta.csv') or (fname == 'mid_rus.csv'):
-        return ('mid_rus', 'tables', 'mid_rus.csv');
-
-    if (path == '/ruscorpora/trunk/corpora/slav/mid_rus_new/texts'):
-      if (fname == 'mosk_del_byt_pism-1') or (fname == 'pskov_letopisi') or (fname == 'morozov') or (fname == 'jaroslav_etc') or (fname == 'gramoty_akty_14_16') or (fname == 'gramotki_17_18') or (fname == 'duhovnye_dogovornye') or (fname == 'BDRL') or (fname == 'letopisets') or (fname == 'polotsk'):
-        return ('mid_rus', 'texts/%s' % fname.lower());
-      if (fname == 'afz1') or (fname == 'afz2') or (fname == 'afz3') or (fname == 'amg') or (fname == 'apd') or (fname == 'bdrl') or (fname == 'drama') or (fname == 'gvnp') or (fname == 'kungur') or (fname == 'letopisi_varia') or (fname == 'nkl') or (fname == 'pososhkov') or (fname == 'psrl34') or (fname == 'rd') or (fname == 'rib') or (fname == 'st_kn') or (fname == 'statspis') or (fname == 'varia') or (fname == 'varia2') or (fname == 'zagovor') or (fname == 'lebedev'):
-        return ('mid_rus', 'texts/%s' % fname.lower());
+def _TreePathMapping(indent, fname, path, log):
+  return _path_rules.Map(indent, fname, path, log)
 
-    if (path == '/ruscorpora/trunk/corpora/slav/mid_rus_new/tables'):
-      if (fname == 'mid_rus_new.csv'):
-        return ('mid_rus', 'tables', 'mid_rus.csv');
-        
-        
-
-  print("ERR: FIXME unprocessed L%d entry %s/%s" % (indent, path, fname), file=log);
-  return MAP_DROP
-  
 
 
 def _LookupFile(_trgt, sha1, mode, fname, _fname, log):
   #FIXME: lookup fixed file sha here
-  key = _trgt[-4:] + sha1.hex
+  key = _CacheKey(_trgt, sha1.raw)
 
-  if key in _local_file_cache:
-    cached_file = _local_file_cache[key]
-  else:
+  cached_file = _local_file_cache.get(key)
+  if cached_file is None:
     cached_file = _file_cache.get(key)
 
   if cached_file:
@@ -714,25 +482,31 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
   changed = False
   entries = OrderedDict({})
 
-  treekey = target[-4:] + root_sha1.raw
+  treekey = _CacheKey(target, root_sha1.raw)
 
-  if treekey in _local_tree_cache:
-    cached_translation = _local_tree_cache[treekey]
-  else:
+  cached_translation = _local_tree_cache.get(treekey)
+  if cached_translation is None:
     cached_translation = _tree_cache.get(treekey)
   
-  if cached_translation and (indent > 5):
+  # Trees mounted into a new root (justmount) and deep ones are not subject to
+  # _TreePathMapping: their translation depends only on treekey. The others
+  # also add to mt_tree, hence they must be walked every time.
+  if cached_translation and (indent > 5 or justmount):
     _local_tree_cache[treekey] = cached_translation
     return SHA1(cached_translation)
 
-  if indent < 7:
+  if indent < 7 and log.trace:
     print('\n_mangle_tree_sha[%d]: %s trgt:%s' % (indent, root_sha1.hex, target), file=log)
 
 
   replace_self_sha1 = None
   base_gitignore_sha1 = None
+  # Whether entries lost the git order of _xtree.
+  renamed = False
 
-  _xtree = ReadGitTree(root_sha1, DIRS.ORIGOBJS, target)
+  objtype, _, tree_payload = ReadGitObj(root_sha1, DIRS.ORIGOBJS, target)
+  assert(objtype == 'tree')
+  _xtree = ParseGitTree(tree_payload)
   for mode, fname, sha1 in _xtree:
     old_sha1_raw = sha1.raw
 
@@ -741,7 +515,8 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
     else:
       resmap = ('unk','')
       
-    print('>  %d %s %s %s/%s :%d => %s:%s' % ( indent, mode, sha1.hex, path, fname, justmount, resmap[0], resmap[1]), file=log);
+    if log.trace:
+      log.Entry(indent, mode, sha1, path, fname, justmount, resmap)
 
 
     if resmap[0] == 'godeepr':
@@ -757,7 +532,7 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
       if mode[0] == '1':  # It's a file
         _, ext = os.path.splitext(fname)
       
-        key = target[-4:] + sha1.hex
+        key = _CacheKey(target, sha1.raw)
       
         if fname == '.gitignore':
           _TreeAppend( entries, mode, fname, sha1, log, path );
@@ -788,9 +563,8 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
           continue;
 
         else:
-          if key in _local_file_cache:
-            cached_file = _local_file_cache[key]
-          else:
+          cached_file = _local_file_cache.get(key)
+          if cached_file is None:
             cached_file = _file_cache.get(key)
 
           if cached_file:
@@ -800,9 +574,11 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
           _fname = fname
           if (fname[-6:] == '.xhtml'):
             changed = True
+            renamed = True
             _fname = fname[:-6] + '.xml';
           elif (fname[-7:] == '.xhtml3'):
             changed = True
+            renamed = True
             _fname = fname[:-7] + '.xml';
           elif (fname[-2:] == '.!'):
             changed = True
@@ -821,6 +597,7 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
 
       else:	#dir
         sha1 = _MangleTree(sha1, target, log, indent+1, '%s/%s' % (path, fname), justmount)
+        changed = changed or (sha1.raw != old_sha1_raw)
         _TreeAppend( entries, mode, fname, sha1, log, path );
 
       continue;
@@ -850,7 +627,8 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
           _TreeAddDir(mt_tree, _trgt, log)
           _mt = mt_tree[_trgt][3]
           for i, elm in enumerate(_pathelements):
-            print('dddd: %d,%s %d' % (i, elm, len(_pathelements)-1), file=log)
+            if log.trace:
+              print('dddd: %d,%s %d' % (i, elm, len(_pathelements)-1), file=log)
           
             if (i == len(_pathelements)-1): 
               _TreeAddDir(_mt, elm, log, path, _sha1)
@@ -869,7 +647,8 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
           _sha1 = _LookupFile(_trgt, sha1, mode, fname, _fname, log);
           _TreeAppend( _mt, mode, _fname, _sha1, log, path)
           
-          _DumpTree('>', _mt, log);
+          if log.trace:
+            _DumpTree('>', _mt, log);
           continue;
           
       else: #path = '' => godeepr
@@ -885,8 +664,9 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
   # end of loop
 
   if (indent == 0):
-    print("INF: L0 dump mt_tree", file=log);
-    _DumpTree('>', mt_tree, log);
+    if log.trace:
+      print("INF: L0 dump mt_tree", file=log);
+      _DumpTree('>', mt_tree, log);
 
     split_trees = _RootMaterializeTree( mt_tree, DIRS.NEWOBJS, '', log);
     return split_trees;
@@ -898,8 +678,11 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
       print("EEE: Unsolicited write to objdir: %s %d %s %d" % (target, indent, path, len(entries)), file=log)
       print(entries.values(), file=log);
       res = root_sha1
+    elif not changed and len(entries) == len(_xtree):
+      # Nothing translated: store the original tree as it is.
+      res = WriteGitObj('tree', tree_payload, target)
     else:
-      res = WriteGitTree(entries.values(), target)
+      res = WriteGitTree(entries.values(), target, presorted=not renamed)
 
     collision = _tree_cache.setdefault(treekey, res.raw)
     if (collision != res.raw):
@@ -914,7 +697,6 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
     
 
       
-  log.flush();
   #assert(collision == res.raw)
   return res
 
@@ -923,9 +705,7 @@ def _MangleTree(root_sha1, target, log, indent, path, justmount):
 def _TranslateOneTree(treeish):
   p = multiprocessing.current_process()
 
-  log = open('log/rt-%d.log' % p.pid, 'a')
-  
-  print('hello from process %s with pid %s' % (p.name, p.pid), file=log)
+  log = _WorkerLog('rt')
   try:
     # Do not bother checking if we already translated the tree. It is extremely
     # unlikely (i.e. empty commits) and is not worth the overhead of checking.
@@ -936,18 +716,21 @@ def _TranslateOneTree(treeish):
     split_trees = _MangleTree(SHA1.FromHex(treeish), DIRS.NEWOBJS, log, 0, '', 0)
 
     if (split_trees is None): #empty tree
-      return;
+      return treeish, [];
 
+    records = []
     for repo in split_trees:
-      key = "%s:%s" % (treeish, repo)
+      key = _CacheKey(repo, SHA1.HexToRaw(treeish))
       _mangled_sha = split_trees[repo]
       
-      _root_trees.setdefault(key, _mangled_sha.hex)
+      _root_trees.setdefault(key, _mangled_sha.raw)
+      records.append(key + _mangled_sha.raw)
       
 #   assert(collision == mangled_sha1.hex)
 
     sys.stdout.flush();
     sys.stderr.flush();
+    return treeish, records
     
   except Exception as e:
     log.write('\n' + traceback.format_exc());
@@ -965,15 +748,25 @@ def _TimeToStr(seconds):
   return time.strftime('%Hh:%Mm:%Ss', tgmt)
 
 
-def _RewriteTrees(trees):
-  pool = multiprocessing.Pool( min(4, int(multiprocessing.cpu_count())*2) )
+def _RewriteTrees(trees, state=None):
+  journal = None
+  if state:
+    _LoadMap(state, 'trees.root_trees.journal', _root_trees)
+    trees = _SkipJournaledTrees(state, 'trees.done.journal', trees)
+    journal = state.OpenJournal('trees.root_trees.journal', _MAP_RECORD_SIZE)
+    done_journal = state.OpenJournal('trees.done.journal', 20)
+
+  pool, cache_stats = _NewPool(RangePool)
 
   pending = len(trees)
   done = 0
   tstart = time.time()
   checkpoint_done = 0
   checkpoint_time = tstart
-  for _ in pool.imap_unordered(_TranslateOneTree, trees, 5):
+  for treeish, records in pool.imap_unordered(_TranslateOneTree, trees):
+    if journal:
+      journal.Append(records)
+      done_journal.Append([SHA1.HexToRaw(treeish)])
     done += 1
     now = time.time()
     done_since_checkpoint = done - checkpoint_done
@@ -989,68 +782,199 @@ def _RewriteTrees(trees):
 
   pool.close()
   pool.join()
+  cache_stats.Report(sys.stdout)
   elapsed = time.time() - tstart
   print('\nTree rewrite completed in %s (%.1f trees/sec)' % ( _TimeToStr(elapsed), done / elapsed) );
+  if journal:
+    journal.Close()
+    done_journal.Close()
+
+
+
+def _SplitCommit(payload):
+  """Returns the original tree and parents (hex) of a commit object and the
+  rest of it, past them."""
+  assert(payload[0:5] == 'tree ')  # A commit obj should begin with a tree ptr
+  orig_tree = payload[5:45]
+  parents = []
+  pos = 46
+  while payload[pos:pos + 7] == 'parent ':
+    parents.append(payload[pos + 7:pos + 47])
+    pos += 48
+  return orig_tree, parents, payload[pos:]
+
+
+def _IsRewrittenAncestor(target, ancestor, commit):
+  """Whether the rewritten commit ancestor (raw) is an ancestor of commit."""
+  node = _commit_graph.get(_CacheKey(target, ancestor))
+  if node is None:
+    return False
+  generation = node[1]
+  seen = set()
+  stack = [commit]
+  while stack:
+    commit = stack.pop()
+    if commit == ancestor:
+      return True
+    node = _commit_graph.get(_CacheKey(target, commit))
+    # Ancestors have lower generations.
+    if node is None or node[1] <= generation or commit in seen:
+      continue
+    seen.add(commit)
+    stack.extend(node[0])
+  return False
+
+
+def _LinkCommit(target, rev, new_tree, parents, tail):
+  """Writes the commit rev for target, with new_tree (raw) on top of the
+  rewritten parents.
+
+  parents are the original ones and tail the rest of the commit (see
+  _SplitCommit()). The parents must have been linked already: they are looked
+  up in _commit_map, which gets rev too. A parent linked before target existed
+  has no entry for it and counts as _NULL_COMMIT, any other missing parent is
+  an error. A commit which doesn't touch target
+  (new_tree is None, or the same tree of its only parent) is not written and
+  maps to that parent. So do the merges left with one parent, after dropping
+  the ones which became ancestors of the others. Returns the rewritten commit
+  (raw) if it was written, else None.
+  """
+  key = _CacheKey(target, SHA1.HexToRaw(rev))
+  new_parents = []
+  for parent in parents:
+    parent_raw = SHA1.HexToRaw(parent)
+    value = _commit_map.get(_CacheKey(target, parent_raw))
+    if value is None and parent_raw not in _linked_revs:
+      raise RuntimeError('%s, parent of %s, has not been rewritten: the '
+                         'rev-list must list the parents first' % (parent, rev))
+    if value in (None, _NULL_COMMIT):
+      continue
+    if all(value[:20] != x[:20] for x in new_parents):
+      new_parents.append(value)
+  if len(new_parents) > 1:
+    new_parents = [x for x in new_parents if not any(
+        y is not x and _IsRewrittenAncestor(target, x[:20], y[:20])
+        for y in new_parents)]
+
+  if new_tree is None or (len(new_parents) == 1 and
+                          new_parents[0][20:40] == new_tree):
+    #no-change commit
+    _commit_map.setdefault(key, new_parents[0] if new_parents else _NULL_COMMIT)
+    return False
+  
+  new_payload = 'tree ' + SHA1.RawToHex(new_tree) + '\n'
+  for parent in new_parents:
+    new_payload += 'parent ' + SHA1.RawToHex(parent[:20]) + '\n'
+  new_payload += tail
+
+  sha1 = WriteGitObj('commit', new_payload, DIRS.NEWOBJS + '/' + target)
+  parent_nodes = [_commit_graph.get(_CacheKey(target, x[:20]), (None, 0))
+                  for x in new_parents]
+  _commit_graph[_CacheKey(target, sha1.raw)] = (
+      [x[:20] for x in new_parents], 1 + max([0] + [x[1] for x in parent_nodes]))
+  _commit_map.setdefault(key, sha1.raw + new_tree + SHA1.HexToRaw(rev))
+  return sha1.raw
+
+
+def _RewriteCommit(target, rev, payload):
+  """Rewrites the commit rev (payload is its object) for target.
+
+  See _LinkCommit().
+  """
+  orig_tree, parents, tail = _SplitCommit(payload)
+  new_tree = _root_trees.get(_CacheKey(target, SHA1.HexToRaw(orig_tree)))
+  return _LinkCommit(target, rev, new_tree, parents, tail)
+
+
+def _TargetHead(target, rev, head):
+  """Returns the head of target at the original commit rev: the tuple
+  (rewritten commit, corresponding original commit, rewritten tree). head is
+  returned if target has no commit up to rev."""
+  value = _commit_map.get(_CacheKey(target, SHA1.HexToRaw(rev)))
+  if value in (None, _NULL_COMMIT):
+    return head
+  return (SHA1.RawToHex(value[:20]), SHA1.RawToHex(value[40:]),
+          SHA1.RawToHex(value[20:40]))
+
+
+def _RewriteCommits(targets, revs, heads=None):
+  """Rewrites revs, returns the new heads.
+
+  heads is a map of target -> head (see _TargetHead()), the heads of the
+  previous run which are kept if revs don't touch their target. The original
+  commits are read, and their trees mapped, in parallel. Then the commits of
+  each target are linked and written in order, the targets in parallel.
+  """
+  tstart = time.time()
 
+  # commits[i] is the (parents, rest) of the commit revs[i] (see
+  # _SplitCommit()), new_trees[i] the translated trees of its tree, one per
+  # target.
+  commits = [None] * len(revs)
+  new_trees = [None] * len(revs)
+
+  def ReadOneCommit(i):
+    objtype, objlen, payload = ReadGitObj(SHA1.FromHex(revs[i]), DIRS.ORIGOBJS)
+    assert(objtype == 'commit')
+    orig_tree, parents, tail = _SplitCommit(payload)
+    orig_tree = SHA1.HexToRaw(orig_tree)
+    return i, (parents, tail), tuple(
+        _root_trees.get(_CacheKey(target, orig_tree)) for target in targets)
+
+  pool = RangePool(_jobs)
+  done = 0
+  for i, commit, trees in pool.imap_unordered(ReadOneCommit, xrange(len(revs))):
+    commits[i] = commit
+    new_trees[i] = trees
+    done += 1
+    if done % 1000 == 1 or done == len(revs):
+      print('\r%d / %d Commits read' % (done, len(revs)))
+      sys.stdout.flush()
+  pool.close()
+  pool.join()
 
-
-def _RewriteCommits(targets, revs):
-  root_trees = _root_trees.copy()  # Un-proxied local copy for faster lookups.
-
-  total = len(revs)*len(targets)
+  # Only the linking is sequential, and only within each target: the workers
+  # get the results above by forking and share _commit_map.
+  def LinkTarget(t):
+    target = targets[t]
+    graph = {}
+    for i, rev in enumerate(revs):
+      parents, tail = commits[i]
+      raw = _LinkCommit(target, rev, new_trees[i][t], parents, tail)
+      if raw:
+        key = _CacheKey(target, raw)
+        graph[key] = _commit_graph[key]
+    return target, graph
+
+  pool = RangePool(_jobs)
+  linked = 0
   done = 0
-  tstart = time.time()
+  for target, graph in pool.imap_unordered(LinkTarget, range(len(targets))):
+    _commit_graph.update(graph)
+    linked += 1
+    done += len(graph)
+    elapsed = time.time() - tstart
+    print('\r%d / %d Targets rewritten, %d commits (%.1f commits/sec)' % (
+        linked, len(targets), done, done / max(elapsed, 0.001)))
+    sys.stdout.flush()
+  pool.close()
+  pool.join()
+  _linked_revs.update(SHA1.HexToRaw(rev) for rev in revs)
 
+  print('\n')
+  new_heads = {}
   for target in targets:
-    _prev_commit_tree = None
-    last_parent = None
-    last_rewritten_parent = None
-    
-    for rev in revs:
-      objtype, objlen, payload = ReadGitObj(SHA1.FromHex(rev), DIRS.ORIGOBJS)
-      assert(objtype == 'commit')
-      assert(payload[0:5] == 'tree ')  # A commit obj should begin with a tree ptr
-      orig_tree = payload[5:45]
-    
-      key = "%s:%s" % (orig_tree, target)
-      if not (key in root_trees):
-        continue;
-      
-      new_tree = root_trees[key]
-      assert(len(new_tree) == 40)
-      
-      if new_tree == _prev_commit_tree:
-        #no-change commit
-        continue;
-      
-      _prev_commit_tree = new_tree
-      
-      new_payload = 'tree ' + new_tree + '\n'
-
-      if last_parent:
-        new_payload += 'parent ' + last_rewritten_parent + '\n'
+    head = (heads or {}).get(target, (None, None, None))
+    if revs:
+      head = _TargetHead(target, revs[-1], head)
+    _PrintHead(target, head)
+    new_heads[target] = head
 
-      parent = None
-      if (payload[46:52] != 'parent'):
-        new_payload += payload[46:]
-      else:
-        assert(payload[46:52] == 'parent')
-        new_payload += payload[94:]
+  return new_heads
 
-      last_parent = rev
-      sha1 = WriteGitObj('commit', new_payload, DIRS.NEWOBJS + '/' + target)
-      last_rewritten_parent = sha1.hex
-      
-      done += 1
-      
-      if done % 100 == 1 or done == len(revs)*len(targets):
-        compl_rate = (time.time() - tstart) / done
-        eta = _TimeToStr((total - done) * compl_rate)
-        print('\r%d / %d Commits rewritten (%.1f commits/sec), ETA: %s      ' % (done, total, 1 / compl_rate, eta) )
-        sys.stdout.flush()
 
-    print('\n')
-    print('Your new head for %s is %s (which corresponds to %s)' % (target, last_rewritten_parent, last_parent) )
+def _PrintHead(target, head):
+  print('Your new head for %s is %s (which corresponds to %s)' % (target, head[0], head[1]) )
 
 
 
@@ -1058,15 +982,14 @@ def _RewriteCommits(targets, revs):
 
 # collect file for charset conv
 def _CollectTree( root_sha1, target, indent, path, log, justmount):
-  key = target[-4:] + root_sha1.hex
+  key = _CacheKey(target, root_sha1.raw)
   
-  if (key in _local_collected_cache):
-    collected_tree = _local_collected_cache[key]
-  else:
+  collected_tree = _local_collected_cache.get(key)
+  if collected_tree is None:
     collected_tree= _collected_tree.get(key)
     
   if collected_tree and (indent > 4):
-    _local_collected_cache[key] = 1
+    _local_collected_cache[key] = '\x01'
     
     d = {}
     d[target] = []
@@ -1084,7 +1007,8 @@ def _CollectTree( root_sha1, target, indent, path, log, justmount):
     else:
       resmap = ('unk','')
       
-    print('>  %d %s %s %s/%s :%d => %s:%s' % ( indent, mode, sha1.hex, path, fname, justmount, resmap[0], resmap[1]), file=log);
+    if log.trace:
+      log.Entry(indent, mode, sha1, path, fname, justmount, resmap)
 
 
     if resmap[0] == 'godeepr':
@@ -1141,8 +1065,8 @@ def _CollectTree( root_sha1, target, indent, path, log, justmount):
         for _key in _files:
           files[_key].extend( _files[_key] )
     
-  _collected_tree.setdefault( key, 1 )
-  _local_collected_cache[key] = 1
+  _collected_tree.setdefault( key, '\x01' )
+  _local_collected_cache[key] = '\x01'
   
   if(indent == 0):
       for _key in files:
@@ -1154,15 +1078,13 @@ def _CollectTree( root_sha1, target, indent, path, log, justmount):
 def _CollectOneTree(treeish):
   p = multiprocessing.current_process()
 
-  log = open('log/ct-%d.log' % p.pid, 'a')
-  
-  print('hello from process %s with pid %s' % (p.name, p.pid), file=log)
+  log = _WorkerLog('ct')
   try:
     # Do not bother checking if we already translated the tree. It is extremely
     # unlikely (i.e. empty commits) and is not worth the overhead of checking.
     collected_files = _CollectTree(SHA1.FromHex(treeish), '', 0, '', log, 0)
     #print('done: %s: %d files' % (treeish, len(collected_files)))
-    return collected_files
+    return treeish, collected_files
     
   except Exception as e:
     log.write('\n' + traceback.format_exc());
@@ -1175,32 +1097,157 @@ def _CollectOneTree(treeish):
     raise
 
 
-def _CollectTrees( trees, log ):
+def _AddCollectedFile( files, _sha, _key, log ):
+  """Adds the file _sha to be converted for the target _key. Returns 1 if new."""
+  if not _sha in files:
+    files[ _sha ] = _key
+  elif files[ _sha ] == _key:
+    return 0
+  elif isinstance(files[_sha], str):
+    print("duplicate file: %s in %s, %s" % ( SHA1(_sha).hex, files[_sha], _key), file=log)
+    files[ _sha ] = { files[ _sha ]:1, _key:1 }
+  elif not (_key in files[ _sha ]):
+    files[ _sha ][ _key ] = 1
+  else:
+    return 0
+  return 1
+
+
+def _SkipJournaledTrees(state, journal_name, trees):
+  done_trees = set(SHA1.RawToHex(x) for x in state.ReadRecords(journal_name, 20))
+  if done_trees:
+    print('Skipping %d trees already processed by a previous run' % len(done_trees))
+  return _ShaArray(x for x in trees if x not in done_trees)
+
+
+def _IterShaFilesTargets(files):
+  for targets in files.itervalues():
+    if isinstance(targets, str):
+      yield targets
+    else:
+      for target in targets:
+        yield target
+
+
+def _ShaFilesKeys(files):
+  """Returns the _CacheKey()s of all the (target, file) of _CollectTrees()."""
+  keys = []
+  for _sha, targets in files.iteritems():
+    if isinstance(targets, str):
+      keys.append(_CacheKey(targets, _sha))
+    else:
+      keys.extend(_CacheKey(target, _sha) for target in targets)
+  return keys
+
+
+def _LoadMap(state, name, shared_map, record_size=_MAP_RECORD_SIZE):
+  for record in state.ReadRecords(name, record_size):
+    shared_map.setdefault(record[:24], record[24:])
+
+
+def _SaveMap(state, name, shared_map):
+  state.WriteRecords(name, (key + value for key, value in shared_map.iteritems()))
+
+
+def _GraphRecords():
+  """Yields the records of _commit_graph (see _GRAPH_RECORD_SIZE)."""
+  for key, (parents, generation) in _commit_graph.iteritems():
+    for parent in parents or ['\x00' * 20]:
+      yield key + struct.pack('>L', generation) + parent
+
+
+def _LoadRewrite(state):
+  """Loads the maps and heads saved by _SaveRewrite(), for --incremental.
+
+  Returns the last rewritten original commit and the heads (see
+  _RewriteCommits()). The commits rewritten by the previous runs go into
+  _linked_revs.
+  """
+  _LoadMap(state, 'rewrite.collected_trees', _collected_tree, 25)
+  _LoadMap(state, 'rewrite.file_cache', _file_cache)
+  _LoadMap(state, 'rewrite.tree_cache', _tree_cache)
+  _LoadMap(state, 'rewrite.commit_map', _commit_map, _COMMIT_RECORD_SIZE)
+  for record in state.ReadRecords('rewrite.commit_graph', _GRAPH_RECORD_SIZE):
+    parents, _ = _commit_graph.setdefault(
+        record[:24], ([], struct.unpack('>L', record[24:28])[0]))
+    if record[28:] != '\x00' * 20:
+      parents.append(record[28:])
+  _linked_revs.update(state.ReadRecords('rewrite.revs', 20))
+  last_rev = None
+  heads = {}
+  with open(state.Path('rewrite.heads')) as f:
+    for line in f:
+      fields = line.split()
+      if fields[0] == 'last_rev':
+        last_rev = fields[1]
+      else:
+        heads[fields[1]] = tuple(fields[2:])
+  return last_rev, heads
+
+
+def _SaveRewrite(state, last_rev, heads):
+  """Saves what an --incremental run needs to continue the rewrite.
+
+  The new objects of the incremental run reference the ones of the previous
+  runs, which are expected to have been merged into the target repos.
+  """
+  _SaveMap(state, 'rewrite.collected_trees', _collected_tree)
+  _SaveMap(state, 'rewrite.file_cache', _file_cache)
+  _SaveMap(state, 'rewrite.tree_cache', _tree_cache)
+  _SaveMap(state, 'rewrite.commit_map', _commit_map)
+  state.WriteRecords('rewrite.commit_graph', _GraphRecords())
+  state.WriteRecords('rewrite.revs', _linked_revs)
+  # The heads file goes last: it marks the run as complete.
+  lines = ['last_rev %s\n' % last_rev]
+  for target in sorted(heads):
+    if heads[target][0]:
+      lines.append('head %s %s %s %s\n' % ((target,) + heads[target]))
+  WriteFileAtomic(state.Path('rewrite.heads'), ''.join(lines))
+
+
+def _ReadTargetNames(state):
+  """Returns the map of target ids (see _CacheKey) -> target names."""
+  names = {}
+  if os.path.exists(state.Path('collect.targets')):
+    with open(state.Path('collect.targets')) as f:
+      for name in f.read().splitlines():
+        names[_CacheKey(name, '')] = name
+  return names
+
+
+def _CollectTrees( trees, log, state=None ):
   files = {}
-  pool = multiprocessing.Pool( min(8, int(multiprocessing.cpu_count())*2) )
+  _total = 0
+  journal = None
+  if state:
+    target_names = _ReadTargetNames(state)
+    for record in state.ReadRecords('collect.files.journal', _KEY_RECORD_SIZE):
+      _total += _AddCollectedFile(files, record[4:], target_names[record[:4]], log)
+    trees = _SkipJournaledTrees(state, 'collect.trees.journal', trees)
+    journal = state.OpenJournal('collect.files.journal', _KEY_RECORD_SIZE)
+    trees_journal = state.OpenJournal('collect.trees.journal', 20)
+
+  pool, cache_stats = _NewPool(RangePool)
 
   pending = len(trees)
   done = 0
   tstart = time.time()
   checkpoint_done = 0
   checkpoint_time = tstart
-  _total = 0
 
-  for result in pool.imap_unordered(_CollectOneTree, trees, min(5, len(trees) / 5)):
+  for treeish, result in pool.imap_unordered(_CollectOneTree, trees):
+    if journal:
+      new_names = [x for x in result if _CacheKey(x, '') not in target_names]
+      if new_names:
+        with open(state.Path('collect.targets'), 'a') as f:
+          f.write(''.join(x + '\n' for x in new_names))
+        target_names.update((_CacheKey(x, ''), x) for x in new_names)
+      journal.Append(_CacheKey(_key, _sha) for _key in result for _sha in result[_key])
+      trees_journal.Append([SHA1.HexToRaw(treeish)])
+
     for _key in result:
       for _sha in result[_key]:
-        if not _sha in files:
-          files[ _sha ] = _key
-          _total = _total+1
-        elif files[ _sha ] == _key:
-          continue;
-        elif isinstance(files[_sha], str):
-          print("duplicate file: %s in %s, %s" % ( SHA1(_sha).hex, files[_sha], _key), file=log)
-          files[ _sha ] = { files[ _sha ]:1, _key:1 }
-          _total = _total+1
-        elif not (_key in files[ _sha ]):
-          files[ _sha ][ _key ] = 1
-          _total = _total+1
+        _total += _AddCollectedFile(files, _sha, _key, log)
 
     done += 1
     now = time.time()
@@ -1213,8 +1260,12 @@ def _CollectTrees( trees, log ):
 
   pool.close()
   pool.join()
+  cache_stats.Report(sys.stdout)
   elapsed = time.time() - tstart
   print('\nTree collect completed in %s (%.1f trees/sec), %d files' % ( _TimeToStr(elapsed), done / elapsed, len(files) ) );
+  if journal:
+    journal.Close()
+    trees_journal.Close()
 
   #  for _key in files:
   #    print("> Collected %s: %d" % ( _key, len(files[_key])), file=log)
@@ -1222,17 +1273,42 @@ def _CollectTrees( trees, log ):
   return files;
 
 
+# Used by _Squeeze(). The lookbehind keeps the scan of long runs of spaces (not
+# followed by a newline) linear.
+_TRAILING_SPACES_RE = re.compile(r'(?<! ) +\n')
+_BLANK_LINES_RE = re.compile(r'\n{3,}')
+
+
+def _Squeeze( payload, old, new, regex ):
+  """Replaces old with new until there is none left.
+
+  A couple of rounds of replace() are the quickest for the short runs found in
+  most files, regex (which must be equivalent) squeezes the long ones at once.
+  """
+  for _ in xrange(2):
+    if old not in payload:
+      return payload
+    payload = payload.replace(old, new)
+  if old in payload:
+    payload = regex.sub(new, payload)
+  return payload
+
+
 def _Transform( payload ):
   payload = payload.replace('\xef\xbb\xbf', '').replace('\r\n', '\n').replace('<speach', '<speech').replace('</speach>','</speech>');
-  _payload = '';
-  while (_payload != payload):
-    _payload = payload;
-    payload = _payload.replace('\n\n\n\n','\n\n').replace('\n\n\n', '\n\n').replace(' \n', '\n');
-
+  # Strip the trailing spaces, then squeeze the blank lines (which the former
+  # might have joined) to one.
+  payload = _Squeeze(payload, ' \n', '\n', _TRAILING_SPACES_RE)
+  if '\n\n\n' in payload:
+    payload = _Squeeze(payload.replace('\n\n\n\n', '\n\n'), '\n\n\n', '\n\n', _BLANK_LINES_RE)
   return payload
 
 
-def _ConvertFile( sha1, target, log ):
+def _ConvertFile( sha1, targets, log ):
+  """Converts the file once and writes it into the objdirs of all the targets.
+
+  Returns the records (see _ConvertFiles()) for each of the targets.
+  """
 #  cached_file = _file_cache.get(sha1.raw)
 #  if (cached_file):
 #    return cached_file;
@@ -1242,44 +1318,45 @@ def _ConvertFile( sha1, target, log ):
 
   if (enc == 'UTFXML') or (enc == 'UTFDET') or (enc == 'ASCII'):
     # no change
-    new_file_sha1 = WriteGitObj(otype, _Transform(payload), target);
+    new_file_sha1 = WriteGitObjMany(otype, _Transform(payload), targets);
 
   elif (enc == 'UTFBOM'):
-    new_file_sha1 = WriteGitObj(otype, _Transform(payload[3:]), target);
+    new_file_sha1 = WriteGitObjMany(otype, _Transform(payload[3:]), targets);
 
   elif (enc == 'WINXML') or (enc == 'WINDET'):
     new_payload = payload.replace('\x98', '\x20').decode('windows-1251').replace('<?xml version="1.0" encoding="windows-1251"', '<?xml version="1.0" encoding="utf-8"').encode('utf-8');
-    new_file_sha1 = WriteGitObj(otype, _Transform(new_payload), target);
+    new_file_sha1 = WriteGitObjMany(otype, _Transform(new_payload), targets);
   else:
     # no change
-    new_file_sha1 = WriteGitObj(otype, payload, target);
+    new_file_sha1 = WriteGitObjMany(otype, payload, targets);
     assert( sha1.raw == new_file_sha1.raw )
 
-  key = target[-4:] + sha1.hex
+  records = []
+  for target in targets:
+    key = _CacheKey(target, sha1.raw)
 
-  _file_cache.setdefault( key, new_file_sha1.raw );
-  _local_file_cache.setdefault( key, new_file_sha1.raw );
+    _file_cache.setdefault( key, new_file_sha1.raw );
+    _local_file_cache.setdefault( key, new_file_sha1.raw );
+    records.append(key + new_file_sha1.raw)
 
-  return new_file_sha1.raw
+  return records
 
 
 def _ConvertOneFile( tuple ):
   p = multiprocessing.current_process()
 
-  log = open('log/fc-%d.log' % p.pid, 'a')
-  
-  print('hello from process %s with pid %s' % (p.name, p.pid), file=log)
+  log = _WorkerLog('fc')
   try:
     # Do not bother checking if we already translated the tree. It is extremely
     # unlikely (i.e. empty commits) and is not worth the overhead of checking.
 
     targets = tuple[1]
     if isinstance(targets, str):
-      _ConvertFile(SHA1(tuple[0]), DIRS.NEWOBJS+'/'+tuple[1], log)
-    else:
+      targets = [targets]
+    if len(targets) > 1:
       for key in targets:
         print("III: multitarget: %s %s" % (SHA1(tuple[0]).hex, key), file = log);
-        _ConvertFile(SHA1(tuple[0]), DIRS.NEWOBJS+'/'+key, log)
+    return _ConvertFile(SHA1(tuple[0]), [DIRS.NEWOBJS+'/'+x for x in targets], log)
     
   except Exception as e:
     log.write('\n' + traceback.format_exc());
@@ -1293,15 +1370,28 @@ def _ConvertOneFile( tuple ):
 
 
 
-def _ConvertFiles( files, log ):
-  pool = multiprocessing.Pool( min(32, int(multiprocessing.cpu_count())*2) )
+def _ConvertFiles( files, log, state=None ):
+  items = files.items()
+  journal = None
+  if state:
+    _LoadMap(state, 'convert.file_cache.journal', _file_cache)
+    items = [x for x in items if not all(
+        _CacheKey(target, x[0]) in _file_cache
+        for target in ([x[1]] if isinstance(x[1], str) else x[1]))]
+    if len(items) < len(files):
+      print('Skipping %d files converted by a previous run' % (len(files) - len(items)))
+    journal = state.OpenJournal('convert.file_cache.journal', _MAP_RECORD_SIZE)
 
-  pending = len(files)
+  pool, cache_stats = _NewPool()
+
+  pending = len(items)
   done = 0
   tstart = time.time()
   checkpoint_done = 0
   checkpoint_time = tstart
-  for result in pool.imap_unordered(_ConvertOneFile, files.items(), 1000):
+  for result in pool.imap_unordered(_ConvertOneFile, items, 1000):
+    if journal:
+      journal.Append(result)
     done += 1
     now = time.time()
     done_since_checkpoint = done - checkpoint_done
@@ -1313,20 +1403,294 @@ def _ConvertFiles( files, log ):
 
   pool.close()
   pool.join()
+  cache_stats.Report(sys.stdout)
   elapsed = time.time() - tstart
   print('\nFile processing completed in %s (%.1f files/sec)' % ( _TimeToStr(elapsed), done / elapsed ) );
+  if journal:
+    journal.Close()
 
 
 def _ListTargets(base):
   targets = []
   for f in os.listdir(base):
-    if os.path.isdir(os.path.join(base, f)):
+    if f != 'pack' and os.path.isdir(os.path.join(base, f)):
       targets.append(f)
 
   return targets
 
 
+def _DumpShaMap(shafiles):
+  print('\nDumping sha file map\n');
+  with open('shamap.txt', 'w') as f:
+    for key in shafiles:
+      orig_sha = SHA1(key)
+      targets = shafiles[key];
+      
+      if isinstance(targets, str):
+        targets = [ targets ];
+
+      for target in targets:
+        key = _CacheKey(target, orig_sha.raw)
+
+        new_sha = _file_cache.get(key)
+        
+        if new_sha:
+          print('%s %d %s %s' % (orig_sha.hex, len(targets), target, SHA1(new_sha).hex), file=f)
+        else:
+          print('%s %d %s None' % (orig_sha.hex, len(targets), target), file=f)
+
+
+def _RunPhases(trees, revs, heads, phase_state, journal_state):
+  """Runs the steps of the rewrite one after the other, returns the new heads.
+
+  phase_state (a StateDir) checkpoints the completed steps, journal_state the
+  ones in progress.
+  """
+  print('\nStep 1: Collect file names and hashes to fix charset');
+  if phase_state and phase_state.IsDone('collect'):
+    print('Loading the collected files from ' + phase_state.Path('collect.files'))
+    shafiles = {}
+    target_names = _ReadTargetNames(phase_state)
+    for record in phase_state.ReadRecords('collect.files', _KEY_RECORD_SIZE):
+      _AddCollectedFile(shafiles, record[4:], target_names[record[:4]], sys.stdout)
+  else:
+    shafiles = _CollectTrees(trees, sys.stdout, journal_state);
+    if phase_state:
+      phase_state.WriteRecords('collect.files', _ShaFilesKeys(shafiles))
+      WriteFileAtomic(phase_state.Path('collect.targets'), ''.join(
+          x + '\n' for x in set(_IterShaFilesTargets(shafiles))))
+      phase_state.MarkDone('collect')
+
+  print('\nStep 2: Rewrite files in parallel: %d' % len(shafiles) );
+  if phase_state and phase_state.IsDone('convert'):
+    print('Loading the converted files from ' + phase_state.Path('convert.file_cache'))
+    _LoadMap(phase_state, 'convert.file_cache', _file_cache)
+  else:
+    _ConvertFiles(shafiles, sys.stdout, journal_state);
+    if phase_state:
+      phase_state.WriteRecords('convert.file_cache', (
+          key + _file_cache[key] for key in _ShaFilesKeys(shafiles)
+          if key in _file_cache))
+      phase_state.MarkDone('convert')
+
+  _DumpShaMap(shafiles)
+
+  print('\nStep 3: Rewriting trees in parallel')
+  if phase_state and phase_state.IsDone('trees'):
+    print('Loading the rewritten trees from ' + phase_state.Path('trees.root_trees'))
+    _LoadMap(phase_state, 'trees.root_trees', _root_trees)
+  else:
+    _RewriteTrees(trees, journal_state)
+    if phase_state:
+      _SaveMap(phase_state, 'trees.root_trees', _root_trees)
+      phase_state.MarkDone('trees')
+
+  print('\nStep 4: Rewriting commits')
+  targets = sorted(set(_ListTargets(DIRS.NEWOBJS)) | set(heads or {}))
+  return _RewriteCommits(targets, revs, heads)
+
+
+# The functions run by the workers of _RunPipeline(), by kind of task.
+_PIPELINE_TASKS = {
+  'collect': _CollectOneTree,
+  'convert': _ConvertOneFile,
+  'tree': _TranslateOneTree,
+}
+
+
+def _PipelineTask(task):
+  kind, key, arg = task
+  try:
+    return kind, key, _PIPELINE_TASKS[kind](arg)
+  except Exception:
+    # The task has already logged the exception. apply_async() has no way to
+    # report it, hand it over as the result.
+    return 'error', (kind, key), None
+
+
+def _RunPipeline(trees, revs, heads, log):
+  """Runs all the steps of the rewrite at once, in a single pool.
+
+  Files are converted as soon as they are collected, trees are rewritten as
+  soon as all the files they contain are converted and commits are rewritten,
+  in order, as soon as their tree is. Returns the collected files (see
+  _CollectTrees()) and the new heads (see _RewriteCommits()).
+
+  _CollectTree() skips the sub-trees already collected by other tasks: their
+  files are reported by those, which might be still running when a tree is
+  collected. Hence a tree waits for all the collect tasks submitted before its
+  own completed and for the conversion of all the files they reported.
+  """
+  pool, cache_stats = _NewPool()
+  results = Queue.Queue()
+
+  def Submit(kind, key, arg):
+    pool.apply_async(_PipelineTask, [(kind, key, arg)], callback=results.put)
+
+  heads = dict(heads or {})
+  targets = {}  # _CacheKey(target, '') -> target
+  def RefreshTargets():
+    for target in _ListTargets(DIRS.NEWOBJS) + heads.keys():
+      targets[_CacheKey(target, '')] = target
+
+  files = {}
+  collect_next = 0  # Next tree to be collected.
+  collect_pending = 0
+  collect_done = set()
+  collect_prefix = 0  # trees[:collect_prefix] are all collected.
+  convert_next = 0  # Sequence number of the next conversion.
+  convert_done = set()
+  convert_prefix = 0  # Conversions [0, convert_prefix) are all done.
+  # Heaps of (collect_prefix needed, tree index) and (convert_prefix needed,
+  # tree index) of the trees waiting to be rewritten.
+  wait_collect = []
+  wait_convert = []
+  trees_done = [False] * len(trees)
+  trees_rewritten = 0
+  commit_next = 0  # Next rev to be rewritten.
+
+  tstart = time.time()
+  checkpoint_time = tstart
+  RefreshTargets()
+  while commit_next < len(revs):
+    while collect_next < len(trees) and collect_pending < _jobs * 2:
+      Submit('collect', collect_next, trees[collect_next])
+      collect_next += 1
+      collect_pending += 1
+
+    try:
+      kind, key, result = results.get(True, 1)
+    except Queue.Empty:
+      kind = None
+
+    if kind == 'error':
+      pool.terminate()
+      raise RuntimeError('%s task %s failed' % key)
+
+    elif kind == 'collect':
+      collect_pending -= 1
+      collect_done.add(key)
+      while collect_prefix in collect_done:
+        collect_done.remove(collect_prefix)
+        collect_prefix += 1
+      heapq.heappush(wait_collect, (collect_next, key))
+      new_files = OrderedDict()
+      for target, shas in result[1].iteritems():
+        for sha in shas:
+          if _AddCollectedFile(files, sha, target, log):
+            new_files.setdefault(sha, []).append(target)
+      # Files going into several targets are converted once for all of them.
+      for sha, file_targets in new_files.iteritems():
+        Submit('convert', convert_next, (sha, file_targets))
+        convert_next += 1
+
+    elif kind == 'convert':
+      convert_done.add(key)
+      while convert_prefix in convert_done:
+        convert_done.remove(convert_prefix)
+        convert_prefix += 1
+
+    elif kind == 'tree':
+      if any(record[:4] not in targets for record in result[1]):
+        RefreshTargets()
+      trees_done[key] = True
+      trees_rewritten += 1
+      while commit_next < len(revs) and trees_done[commit_next]:
+        rev = revs[commit_next]
+        objtype, objlen, payload = ReadGitObj(SHA1.FromHex(rev), DIRS.ORIGOBJS)
+        assert(objtype == 'commit')
+        for target in targets.itervalues():
+          _RewriteCommit(target, rev, payload)
+        # Targets found later count rev as linked to nothing.
+        _linked_revs.add(SHA1.HexToRaw(rev))
+        commit_next += 1
+
+    while wait_collect and wait_collect[0][0] <= collect_prefix:
+      _, i = heapq.heappop(wait_collect)
+      heapq.heappush(wait_convert, (convert_next, i))
+    while wait_convert and wait_convert[0][0] <= convert_prefix:
+      _, i = heapq.heappop(wait_convert)
+      Submit('tree', i, trees[i])
+
+    now = time.time()
+    if now - checkpoint_time > 5 or commit_next == len(revs):
+      checkpoint_time = now
+      print('\r%d / %d Trees collected, %d / %d Files processed, %d Trees '
+            'rewritten, %d Commits rewritten (%s)      ' % (
+                collect_prefix, len(trees), convert_prefix, convert_next,
+                trees_rewritten, commit_next, _TimeToStr(now - tstart)))
+      sys.stdout.flush()
+
+  pool.close()
+  pool.join()
+  cache_stats.Report(sys.stdout)
+  print('\nPipeline completed in %s' % _TimeToStr(time.time() - tstart))
+
+  RefreshTargets()
+  for target in sorted(targets.itervalues()):
+    heads.setdefault(target, (None, None, None))
+    if revs:
+      heads[target] = _TargetHead(target, revs[-1], heads[target])
+    _PrintHead(target, heads[target])
+  return files, heads
+
+
 def main():
+  parser = optparse.OptionParser(usage='%prog [options] [rev-list-file]')
+  parser.add_option('--packs', action='store_true', default=False,
+                    help='Write the new objects into packs (one per worker '
+                         'and target, under <target>/pack/) rather than as '
+                         'loose objects')
+  parser.add_option('--object-store', type='choice', default='python',
+                    choices=sorted(OBJECT_STORES),
+                    help='How objects are read and written: "python" (default)'
+                         ' does the I/O and zlib in python, "git" goes through '
+                         'git cat-file --batch / fast-import processes')
+  parser.add_option('--local-cache-size', type='int', default=200000,
+                    metavar='N',
+                    help='Max entries of each of the caches local to each '
+                         'worker, roughly 200 bytes per entry, 0 to disable '
+                         'them (default: %default)')
+  parser.add_option('--shared-map-size', type='int', default=16, metavar='M',
+                    help='Capacity, in millions of entries, of each of the '
+                         'maps shared by the workers (default: %default)')
+  parser.add_option('--state-dir', metavar='DIR',
+                    help='Checkpoint the results of each phase into DIR and '
+                         'resume from there if it has the ones of a previous '
+                         'run')
+  parser.add_option('--redo-from', type='choice', choices=_PHASES,
+                    metavar='PHASE',
+                    help='Discard the checkpoints of PHASE (one of %s) and of '
+                         'the following phases' % ', '.join(_PHASES))
+  parser.add_option('--incremental', action='store_true', default=False,
+                    help='Rewrite only the revisions following the last one '
+                         'rewritten by the previous run with the same '
+                         '--state-dir, on top of its heads. Only the new '
+                         'objects are written')
+  parser.add_option('--pipeline', action='store_true', default=False,
+                    help='Run all the steps at once: files are converted as '
+                         'soon as they are collected, trees are rewritten as '
+                         'soon as their files are converted and so on. '
+                         'Only the complete rewrite is checkpointed')
+  parser.add_option('--jobs', '-j', type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of worker processes (default: %default)')
+  parser.add_option('--trace', type='choice', choices=TRACE_MODES,
+                    default=TRACE_OFF, metavar='MODE',
+                    help='Trace every entry of the trees walked by the workers '
+                         'into their logs: one of %s (default: %%default). '
+                         'Binary traces go to log/*.trace, see tracelog.py' %
+                         ', '.join(TRACE_MODES))
+  parser.add_option('--path-rules', metavar='FILE',
+                    default=os.path.join(os.path.dirname(
+                        os.path.abspath(__file__)), 'path_rules.json'),
+                    help='The rules mapping the paths of the original tree '
+                         'onto the target repos (default: %default)')
+  options, args = parser.parse_args()
+  if options.redo_from and not options.state_dir:
+    parser.error('--redo-from requires --state-dir')
+  if options.incremental and (not options.state_dir or options.redo_from):
+    parser.error('--incremental requires --state-dir (and no --redo-from)')
 
   param = 5000
   print('Processing no more than %d commits' % param);
@@ -1344,14 +1708,43 @@ def main():
     print('WARNING: Omitting GCS object generation.')
 
   print('')
-  revs = []
-  trees = []
+  revs = _ShaArray()
+  trees = _ShaArray()
+
+  if options.packs:
+    print('Writing new objects into packs')
+    UsePackWriters()
+  print('Object store:', options.object_store)
+  SetObjectStore(OBJECT_STORES[options.object_store]())
+  global _jobs, _path_rules, _trace_mode
+  _jobs = options.jobs
+  _trace_mode = options.trace
+  _path_rules = LoadPathRules(options.path_rules)
+  _CreateSharedMaps(options.shared_map_size * 1000000)
+  _CreateLocalCaches(options.local_cache_size)
+
+  state = None
+  journal_state = None
+  if options.state_dir:
+    print('Checkpoints:', options.state_dir)
+    state = StateDir(options.state_dir, _PHASES)
+    if options.redo_from:
+      state.RedoFrom(options.redo_from)
+    # Objects written into packs or through git fast-import are durable only
+    # once their writer is closed, i.e. at the end of each phase. Journaling
+    # the tasks completed in the middle of a phase is safe only for loose
+    # objects.
+    if not options.packs and options.object_store == 'python':
+      journal_state = state
+    else:
+      print('Checkpointing only completed phases (--packs / --object-store)')
 
-  if len(sys.argv) > 1:
-    print('Reading cached rev-list + trees from ' + sys.argv[1])
-    reader = open(sys.argv[1])
+  if args:
+    print('Reading cached rev-list + trees from ' + args[0])
+    reader = open(args[0])
   else:
-    cmd = ['git', 'rev-list', '--format=%T', '--reverse', 'master']
+    cmd = ['git', 'rev-list', '--format=%T', '--reverse', '--topo-order',
+           'master']
     print('Running [%s], might take a while' % ' '.join(cmd))
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=1048576)
     reader = proc.stdout
@@ -1377,37 +1770,45 @@ def main():
   assert(len(revs) == len(trees))
   print('Got %d revisions to rewrite' % len(revs))
 
-  print('\nStep 1: Collect file names and hashes to fix charset');
-  shafiles = _CollectTrees(trees[0:param], sys.stdout);
-
-  print('\nStep 2: Rewrite files in parallel: %d' % len(shafiles) );
-  _ConvertFiles(shafiles, sys.stdout);
-
-  print('\nDumping sha file map\n');
-  with open('shamap.txt', 'w') as f:
-    for key in shafiles:
-      orig_sha = SHA1(key)
-      targets = shafiles[key];
-      
-      if isinstance(targets, str):
-        targets = [ targets ];
-
-      for target in targets:
-        key = target[-4:] + orig_sha.hex
-
-        new_sha = _file_cache.get(key)
-        
-        if new_sha:
-          print('%s %d %s %s' % (orig_sha.hex, len(targets), target, SHA1(new_sha).hex), file=f)
-        else:
-          print('%s %d %s None' % (orig_sha.hex, len(targets), target), file=f)
-
-  print('\nStep 3: Rewriting trees in parallel')
-  _RewriteTrees(trees[0:param])
-
-  print('\nStep 3: Rewriting commits serially')
-  targets = _ListTargets(DIRS.NEWOBJS)
-  _RewriteCommits(targets, revs[0:param])
+  # With --incremental the phases start from the maps of the previous run
+  # rather than from their own checkpoints, which are left untouched.
+  # --pipeline has no phases to checkpoint.
+  phase_state = state
+  heads = None
+  if options.incremental:
+    if not os.path.exists(state.Path('rewrite.heads')):
+      parser.error('no complete rewrite in %s to continue' % state.path)
+    last_rev, heads = _LoadRewrite(state)
+    if not _linked_revs:
+      # Saved before rewrite.revs existed: the revs up to last_rev are done.
+      if last_rev not in revs:
+        parser.error('%s, last rewritten by the previous run, is not in the '
+                     'rev-list' % last_rev)
+      _linked_revs.update(SHA1.HexToRaw(rev)
+                          for rev in revs[:revs.index(last_rev) + 1])
+    # New commits are not necessarily after last_rev in the rev-list (e.g.
+    # the ones of a branch merged since), hence the revs are filtered.
+    new = [i for i in xrange(len(revs))
+           if SHA1.HexToRaw(revs[i]) not in _linked_revs]
+    print('Continuing the rewrite: %d new revisions' % len(new))
+    revs = _ShaArray(revs[i] for i in new)
+    trees = _ShaArray(trees[i] for i in new)
+    phase_state = journal_state = None
+  if options.pipeline:
+    phase_state = journal_state = None
+  revs = revs[:param]
+  trees = trees[:param]
+
+  if options.pipeline:
+    print('\nRunning all the steps as a pipeline')
+    shafiles, heads = _RunPipeline(trees, revs, heads, sys.stdout)
+    _DumpShaMap(shafiles)
+  else:
+    heads = _RunPhases(trees, revs, heads, phase_state, journal_state)
+  CloseObjectStore()
+  if state and revs:
+    print('Saving the rewrite state into ' + state.path)
+    _SaveRewrite(state, revs[-1], heads)
 
   print('You should now run git fsck NEW_HEAD_SHA. You are a fool if you don\'t')
 #  sys.exit(1);
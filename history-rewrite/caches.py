@@ -0,0 +1,244 @@
+# -*- mode:python -*-
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Caches shared between (or local to) the workers of the history rewrite.
+"""
+
+import Queue
+import mmap
+import multiprocessing
+import multiprocessing.util
+import struct
+
+
+class SharedMapFull(Exception):
+  pass
+
+
+class SharedMap(object):
+  """A fixed-width key -> value hash table, shared by forked processes.
+
+  The table lives in an anonymous shared mmap, hence it must be created before
+  forking the workers (e.g. before creating a multiprocessing.Pool). It is split
+  in stripes, each with its own lock and slots (open addressing with linear
+  probing within the stripe).
+  Entries can be added (setdefault) but never changed or removed, so readers
+  don't need any lock: the state byte of a slot is written after its contents.
+  """
+
+  _EMPTY = '\x00'
+  _FULL = '\x01'
+  _MAX_LOAD = 0.7
+
+  def __init__(self, capacity, key_size=24, value_size=20, stripes=64):
+    self.key_size = key_size
+    self.value_size = value_size
+    self._slot_size = 1 + key_size + value_size
+    self._stripes = stripes
+    self._max_stripe_len = capacity / stripes + 1
+    self._stripe_slots = int(self._max_stripe_len / self._MAX_LOAD) + 1
+    self._stripe_size = self._stripe_slots * self._slot_size
+    self._header_size = 8 * stripes  # The number of entries of each stripe.
+    self._mm = mmap.mmap(-1, self._header_size + stripes * self._stripe_size)
+    self._locks = [multiprocessing.Lock() for _ in xrange(stripes)]
+
+  def _Find(self, key):
+    """Returns (stripe, slot offset, found). The offset is None if full."""
+    assert(len(key) == self.key_size)
+    mm = self._mm
+    h = hash(key)
+    stripe = h % self._stripes
+    base = self._header_size + stripe * self._stripe_size
+    idx = (h / self._stripes) % self._stripe_slots
+    for _ in xrange(self._stripe_slots):
+      pos = base + idx * self._slot_size
+      if mm[pos] == self._EMPTY:
+        return stripe, pos, False
+      if mm[pos + 1:pos + 1 + self.key_size] == key:
+        return stripe, pos, True
+      idx = idx + 1 if idx + 1 < self._stripe_slots else 0
+    return stripe, None, False
+
+  def _Value(self, pos):
+    return self._mm[pos + 1 + self.key_size:pos + self._slot_size]
+
+  def get(self, key, default=None):
+    _, pos, found = self._Find(key)
+    return self._Value(pos) if found else default
+
+  def __getitem__(self, key):
+    _, pos, found = self._Find(key)
+    if not found:
+      raise KeyError(key)
+    return self._Value(pos)
+
+  def __contains__(self, key):
+    return self._Find(key)[2]
+
+  def setdefault(self, key, value):
+    assert(len(value) == self.value_size)
+    stripe, pos, found = self._Find(key)
+    if found:
+      return self._Value(pos)
+    with self._locks[stripe]:
+      # Look again: another process might have added it in the meantime.
+      stripe, pos, found = self._Find(key)
+      if found:
+        return self._Value(pos)
+      count, = struct.unpack_from('<Q', self._mm, stripe * 8)
+      if pos is None or count >= self._max_stripe_len:
+        raise SharedMapFull('Stripe %d is full (%d entries)' % (stripe, count))
+      self._mm[pos + 1:pos + self._slot_size] = key + value
+      self._mm[pos] = self._FULL
+      struct.pack_into('<Q', self._mm, stripe * 8, count + 1)
+    return value
+
+  def __len__(self):
+    return sum(struct.unpack_from('<%dQ' % self._stripes, self._mm, 0))
+
+  def iteritems(self):
+    mm, key_size = self._mm, self.key_size
+    for pos in xrange(self._header_size, len(mm), self._slot_size):
+      if mm[pos] == self._FULL:
+        yield (mm[pos + 1:pos + 1 + key_size],
+               mm[pos + 1 + key_size:pos + self._slot_size])
+
+
+class BoundedCache(object):
+  """A process-local cache of up to max_entries, evicted with CLOCK.
+
+  Each entry has a reference bit, set when the entry is used. When the cache is
+  full, the clock hand sweeps the entries clearing the bits and evicts the first
+  one not referenced since the previous sweep: a cheap approximation of LRU.
+  A cache of 0 entries stores nothing.
+  """
+
+  def __init__(self, name, max_entries):
+    self.name = name
+    self.max_entries = max_entries
+    self._index = {}  # key -> slot
+    self._keys = []
+    self._values = []
+    self._referenced = bytearray()
+    self._hand = 0
+    self.ResetStats()
+
+  def ResetStats(self):
+    self.hits = self.misses = self.evictions = 0
+
+  def __len__(self):
+    return len(self._index)
+
+  def get(self, key, default=None):
+    slot = self._index.get(key)
+    if slot is None:
+      self.misses += 1
+      return default
+    self.hits += 1
+    self._referenced[slot] = 1
+    return self._values[slot]
+
+  def __setitem__(self, key, value):
+    slot = self._index.get(key)
+    if slot is None:
+      if self.max_entries <= 0:
+        return
+      if len(self._keys) < self.max_entries:
+        slot = len(self._keys)
+        self._keys.append(key)
+        self._values.append(value)
+        self._referenced.append(1)
+        self._index[key] = slot
+        return
+      slot = self._Evict()
+      self._keys[slot] = key
+      self._index[key] = slot
+    self._values[slot] = value
+    self._referenced[slot] = 1
+
+  def setdefault(self, key, value):
+    slot = self._index.get(key)
+    if slot is not None:
+      return self._values[slot]
+    self[key] = value
+    return value
+
+  def _Evict(self):
+    referenced = self._referenced
+    while referenced[self._hand]:
+      referenced[self._hand] = 0
+      self._hand = (self._hand + 1) % self.max_entries
+    slot = self._hand
+    self._hand = (self._hand + 1) % self.max_entries
+    del self._index[self._keys[slot]]
+    self.evictions += 1
+    return slot
+
+
+class PoolCacheStats(object):
+  """Gathers the counters of the BoundedCache-s of the workers of a pool.
+
+  Create it before the pool and pass InitWorker as the pool initializer. Each
+  worker sends its counters to the parent when it exits, Report() sums them up
+  (call it after pool.join()).
+  """
+
+  def __init__(self, caches):
+    self._caches = caches
+    self._queue = multiprocessing.Queue()
+
+  def InitWorker(self):
+    for cache in self._caches:
+      cache.ResetStats()
+    multiprocessing.util.Finalize(None, self._Send, exitpriority=10)
+
+  def _Send(self):
+    self._queue.put([(c.name, c.hits, c.misses, c.evictions, len(c))
+                     for c in self._caches])
+    self._queue.close()
+    self._queue.join_thread()
+
+  def Report(self, out):
+    totals = {}
+    while True:
+      try:
+        worker_stats = self._queue.get_nowait()
+      except Queue.Empty:
+        break
+      for name, hits, misses, evictions, entries in worker_stats:
+        total = totals.setdefault(name, [0, 0, 0, 0])
+        total[0] += hits
+        total[1] += misses
+        total[2] += evictions
+        total[3] = max(total[3], entries)
+    for cache in self._caches:
+      hits, misses, evictions, entries = totals.get(cache.name, (0, 0, 0, 0))
+      if not hits + misses + evictions:
+        continue
+      out.write('Cache %s: %d hits, %d misses (%.1f%% hits), %d evictions, '
+                'up to %d entries per worker\n' % (
+                    cache.name, hits, misses,
+                    100.0 * hits / max(hits + misses, 1), evictions, entries))
@@ -0,0 +1,114 @@
+# -*- mode:python -*-
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+On-disk checkpoints of the phases of the history rewrite.
+
+The maps produced by each phase are stored as files of sorted fixed-width
+records. Phases still in progress append their results to journals (unsorted
+records of the same kind), so that a crashed run can be resumed from the last
+completed task rather than from scratch.
+"""
+
+import os
+import time
+
+from gitutils import Makedirs, WriteFileAtomic
+
+
+class StateDir(object):
+  """The checkpoints of a rewrite, kept in a directory.
+
+  phases is the ordered list of phase names. The files of each phase are named
+  <phase>.<name>; <phase>.done marks the phase as completed.
+  """
+
+  def __init__(self, path, phases):
+    self.path = path
+    self.phases = phases
+    Makedirs(path)
+
+  def Path(self, name):
+    return os.path.join(self.path, name)
+
+  def IsDone(self, phase):
+    return os.path.exists(self.Path(phase + '.done'))
+
+  def MarkDone(self, phase):
+    """Marks the phase as completed, discarding its journals."""
+    WriteFileAtomic(self.Path(phase + '.done'), time.ctime() + '\n')
+    for fname in os.listdir(self.path):
+      if fname.startswith(phase + '.') and fname.endswith('.journal'):
+        os.remove(self.Path(fname))
+
+  def RedoFrom(self, phase):
+    """Discards the checkpoints of phase and of all the following ones."""
+    redo = self.phases[self.phases.index(phase):]
+    for fname in os.listdir(self.path):
+      if fname.split('.', 1)[0] in redo:
+        os.remove(self.Path(fname))
+
+  def WriteRecords(self, name, records):
+    WriteFileAtomic(self.Path(name), ''.join(sorted(records)))
+
+  def ReadRecords(self, name, record_size):
+    """Yields the records of a records file or journal (if it exists)."""
+    path = self.Path(name)
+    if not os.path.exists(path):
+      return
+    with open(path, 'rb') as f:
+      while True:
+        chunk = f.read(record_size * 65536)
+        # A journal might end with a torn record: ignore it.
+        for i in xrange(0, len(chunk) - record_size + 1, record_size):
+          yield chunk[i:i + record_size]
+        if len(chunk) < record_size * 65536:
+          break
+
+  def OpenJournal(self, name, record_size):
+    return Journal(self.Path(name), record_size)
+
+
+class Journal(object):
+  """An append-only file of fixed-width records."""
+
+  def __init__(self, path, record_size):
+    self.record_size = record_size
+    self._file = open(path, 'ab')
+    # Drop the torn record left by a crash, if any, before appending.
+    self._file.seek(0, os.SEEK_END)
+    size = self._file.tell()
+    if size % record_size:
+      self._file.truncate(size - size % record_size)
+      self._file.seek(0, os.SEEK_END)
+
+  def Append(self, records):
+    data = ''.join(records)
+    assert(len(data) % self.record_size == 0)
+    self._file.write(data)
+    self._file.flush()
+
+  def Close(self):
+    self._file.close()
@@ -24,12 +24,18 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 """
-A set of helper functions to read / write Git loose objects.
+A set of helper functions to read / write Git loose objects and packs.
 """
 
+import collections
 import hashlib
+import mmap
+import multiprocessing.util
 import os
+import shutil
+import struct
 import subprocess
+import tempfile
 import zlib
 
 class SHA1:
@@ -66,26 +72,414 @@ def WriteFileAtomic(file_path, data):
   os.rename(tmp_path, file_path)
 
 
-def WriteGitObj(objtype, payload, objdir):
-  data = ('%s %d\x00' % (objtype, len(payload))) + payload
-  hasher = hashlib.sha1()
-  hasher.update(data)
+def _WritePythonGitObj(objtype, payload, objdir):
+  if _pack_writers is not None:
+    return _GetPackWriter(objdir).Write(objtype, payload)
+  return _WritePythonGitObjMany(objtype, payload, [objdir])
+
+
+def _WritePythonGitObjMany(objtype, payload, objdirs):
+  """Writes the object into each of objdirs, compressing it only once.
+
+  Loose objects are hard-linked to the first copy when possible.
+  """
+  header = '%s %d\x00' % (objtype, len(payload))
+  hasher = hashlib.sha1(header)
+  hasher.update(payload)
   sha1 = SHA1(hasher.digest())
-  #basedir = os.path.join(_gitdir, 'objects', sha1.hex[0:2])
-  basedir = os.path.join(objdir, sha1.hex[0:2])
-  objpath = os.path.join(basedir, sha1.hex[2:])
-  if not os.path.exists(objpath):
-    Makedirs(basedir)
-    WriteFileAtomic(objpath, zlib.compress(data, 1))
+  if _pack_writers is not None:
+    compressed = zlib.compress(payload, 1)
+    for objdir in objdirs:
+      _GetPackWriter(objdir).Write(objtype, payload, sha1, compressed)
+    return sha1
+
+  compressed = None
+  first_path = None
+  for objdir in objdirs:
+    #basedir = os.path.join(_gitdir, 'objects', sha1.hex[0:2])
+    basedir = os.path.join(objdir, sha1.hex[0:2])
+    objpath = os.path.join(basedir, sha1.hex[2:])
+    if not os.path.exists(objpath):
+      Makedirs(basedir)
+      if first_path:
+        try:
+          os.link(first_path, objpath)
+        except OSError:
+          pass  # e.g. on another filesystem: write a copy below.
+      if not os.path.exists(objpath):
+        if compressed is None:
+          compressed = zlib.compress(header + payload, 1)
+        WriteFileAtomic(objpath, compressed)
+    first_path = first_path or objpath
   return sha1
 
 
-def ReadGitObj(sha1, objdir, objdir2 = ''):
+_PACK_OBJ_TYPES = {'commit': 1, 'tree': 2, 'blob': 3, 'tag': 4}
+
+
+class PackWriter(object):
+  """Streams new objects into a (non-deltified) pack file under objdir/pack/.
+
+  Objects are zlib-compressed and appended as they come; an object whose SHA1
+  is already in the pack is not written again. Close() patches the object count
+  in the header, appends the pack checksum, writes the matching .idx (v2) and
+  gives both files their final pack-<sha1> name.
+  """
+
+  def __init__(self, objdir):
+    self.objdir = objdir
+    self.packdir = os.path.join(objdir, 'pack')
+    Makedirs(self.packdir)
+    fd, self._tmp_path = tempfile.mkstemp(prefix='tmp_pack_', dir=self.packdir)
+    self._file = os.fdopen(fd, 'w+b')
+    # The object count is not known yet, it is patched by Close().
+    self._file.write(struct.pack('>4sLL', 'PACK', 2, 0))
+    self._offset = 12
+    self._entries = {}  # raw SHA1 -> (offset, crc32)
+
+  def __len__(self):
+    return len(self._entries)
+
+  def Write(self, objtype, payload, sha1=None, compressed=None):
+    """Appends the object, returns its SHA1.
+
+    sha1 and compressed (the zlib stream of payload) can be passed if already
+    known, e.g. when the same object goes into several packs.
+    """
+    if sha1 is None:
+      hasher = hashlib.sha1('%s %d\x00' % (objtype, len(payload)))
+      hasher.update(payload)
+      sha1 = SHA1(hasher.digest())
+    if sha1.raw in self._entries:
+      return sha1
+
+    # Object header: type and size, as a little-endian base-128 varint.
+    size = len(payload)
+    header = chr((0x80 if size > 15 else 0) | (_PACK_OBJ_TYPES[objtype] << 4) |
+                 (size & 15))
+    size >>= 4
+    while size:
+      header += chr((0x80 if size > 127 else 0) | (size & 127))
+      size >>= 7
+    data = header + (compressed or zlib.compress(payload, 1))
+    self._file.write(data)
+    self._entries[sha1.raw] = (self._offset, zlib.crc32(data) & 0xffffffff)
+    self._offset += len(data)
+    return sha1
+
+  def Close(self):
+    """Finalizes the pack. Returns its path, None if no object was written."""
+    if not self._entries:
+      self._file.close()
+      os.remove(self._tmp_path)
+      return None
+
+    self._file.seek(8)
+    self._file.write(struct.pack('>L', len(self._entries)))
+    self._file.seek(0)
+    hasher = hashlib.sha1()
+    while True:
+      chunk = self._file.read(1048576)
+      if not chunk:
+        break
+      hasher.update(chunk)
+    pack_sha1 = hasher.digest()
+    self._file.seek(0, os.SEEK_END)  # Required by stdio between read & write.
+    self._file.write(pack_sha1)
+    self._file.close()
+
+    base_path = os.path.join(self.packdir, 'pack-' + SHA1.RawToHex(pack_sha1))
+    os.rename(self._tmp_path, base_path + '.pack')
+    WriteFileAtomic(base_path + '.idx', self._BuildIndex(pack_sha1))
+    return base_path + '.pack'
+
+  def _BuildIndex(self, pack_sha1):
+    shas = sorted(self._entries)
+    fanout = [0] * 256
+    for sha in shas:
+      fanout[ord(sha[0])] += 1
+    for i in xrange(1, 256):
+      fanout[i] += fanout[i - 1]
+
+    offsets = []
+    large_offsets = []
+    for sha in shas:
+      offset = self._entries[sha][0]
+      if offset < 0x80000000:
+        offsets.append(offset)
+      else:
+        offsets.append(0x80000000 | len(large_offsets))
+        large_offsets.append(offset)
+
+    idx = ''.join((
+        struct.pack('>4sL', '\xfftOc', 2),
+        struct.pack('>256L', *fanout),
+        ''.join(shas),
+        struct.pack('>%dL' % len(shas), *(self._entries[x][1] for x in shas)),
+        struct.pack('>%dL' % len(offsets), *offsets),
+        struct.pack('>%dQ' % len(large_offsets), *large_offsets),
+        pack_sha1))
+    return idx + hashlib.sha1(idx).digest()
+
+
+# objdir -> PackWriter of the current process. None when writing loose objects.
+_pack_writers = None
+_pack_writers_pid = None
+_inherited_pack_writers = []
+
+
+def UsePackWriters():
+  """Makes WriteGitObj append to packs rather than creating loose objects.
+
+  Each process (e.g. each worker of a multiprocessing.Pool) gets its own
+  PackWriter for each objdir, finalized when the process exits or when
+  ClosePackWriters() is called.
+  """
+  global _pack_writers
+  _pack_writers = {}
+
+
+def _GetPackWriter(objdir):
+  global _pack_writers, _pack_writers_pid
+  if _pack_writers_pid != os.getpid():
+    # Writers inherited through fork() belong to the parent process. Keep them
+    # referenced, so that their buffers are never flushed by this process.
+    _inherited_pack_writers.append(_pack_writers)
+    _pack_writers = {}
+    _pack_writers_pid = os.getpid()
+    multiprocessing.util.Finalize(None, ClosePackWriters, exitpriority=10)
+  writer = _pack_writers.get(objdir)
+  if writer is None:
+    writer = _pack_writers[objdir] = PackWriter(objdir)
+  return writer
+
+
+def ClosePackWriters():
+  if _pack_writers_pid != os.getpid():
+    return
+  for objdir in sorted(_pack_writers):
+    _pack_writers.pop(objdir).Close()
+
+
+_PACK_OBJ_TYPE_NAMES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+_OFS_DELTA = 6
+_REF_DELTA = 7
+
+
+def _ApplyDelta(base, delta):
+  def ReadVarint(pos):
+    value = shift = 0
+    while True:
+      byte = ord(delta[pos])
+      pos += 1
+      value |= (byte & 0x7f) << shift
+      shift += 7
+      if not byte & 0x80:
+        return value, pos
+
+  base_size, pos = ReadVarint(0)
+  assert(base_size == len(base))
+  result_size, pos = ReadVarint(pos)
+  chunks = []
+  while pos < len(delta):
+    cmd = ord(delta[pos])
+    pos += 1
+    if cmd & 0x80:  # Copy from base: offset and size are sparse little-endian.
+      offset = size = 0
+      for i in xrange(4):
+        if cmd & (1 << i):
+          offset |= ord(delta[pos]) << (i * 8)
+          pos += 1
+      for i in xrange(3):
+        if cmd & (0x10 << i):
+          size |= ord(delta[pos]) << (i * 8)
+          pos += 1
+      chunks.append(base[offset:offset + (size or 0x10000)])
+    else:  # Insert the next cmd bytes.
+      assert(cmd)
+      chunks.append(delta[pos:pos + cmd])
+      pos += cmd
+  result = ''.join(chunks)
+  assert(len(result) == result_size)
+  return result
+
+
+class PackReader(object):
+  """Reads objects from a pack file through its (v2) index, both mmap-ed.
+
+  Deltified objects are resolved in Python. The most recently used delta bases
+  are kept in a LRU cache of (up to) cache_bytes, as consecutive objects tend
+  to share the same delta chains.
+  """
+
+  def __init__(self, pack_path, cache_bytes=64 * 1048576):
+    self.pack_path = pack_path
+    with open(pack_path[:-len('.pack')] + '.idx', 'rb') as f:
+      self._idx = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with open(pack_path, 'rb') as f:
+      self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version = struct.unpack_from('>4sL', self._idx, 0)
+    assert(magic == '\xfftOc' and version == 2)
+    self._fanout = struct.unpack_from('>256L', self._idx, 8)
+    self._count = self._fanout[255]
+    self._shas_pos = 8 + 256 * 4
+    self._offsets_pos = self._shas_pos + self._count * (20 + 4)
+    self._large_offsets_pos = self._offsets_pos + self._count * 4
+    self._cache = collections.OrderedDict()  # offset -> (type, data)
+    self._cache_bytes = 0
+    self._max_cache_bytes = cache_bytes
+
+  def __len__(self):
+    return self._count
+
+  def FindOffset(self, raw_sha1):
+    """Returns the offset of the object in the pack, None if not there."""
+    first = ord(raw_sha1[0])
+    lo = self._fanout[first - 1] if first else 0
+    hi = self._fanout[first]
+    idx, shas_pos = self._idx, self._shas_pos
+    while lo < hi:
+      mid = (lo + hi) / 2
+      pos = shas_pos + mid * 20
+      cur = idx[pos:pos + 20]
+      if cur < raw_sha1:
+        lo = mid + 1
+      elif cur > raw_sha1:
+        hi = mid
+      else:
+        offset, = struct.unpack_from('>L', idx, self._offsets_pos + mid * 4)
+        if offset & 0x80000000:
+          offset, = struct.unpack_from(
+              '>Q', idx, self._large_offsets_pos + (offset & 0x7fffffff) * 8)
+        return offset
+    return None
+
+  def Read(self, raw_sha1):
+    """Returns the tuple (objtype, payload), None if the object is not here."""
+    offset = self.FindOffset(raw_sha1)
+    if offset is None:
+      return None
+    return self._ReadAt(offset)
+
+  def _ReadAt(self, offset):
+    # Walk the delta chain down to a base which is either cached or not a delta.
+    chain = []
+    while True:
+      cached = self._cache.pop(offset, None)
+      if cached is not None:
+        self._cache[offset] = cached  # Most recently used go last.
+        objtype, data = cached
+        break
+      objtype, size, pos = self._ReadHeader(offset)
+      if objtype == _OFS_DELTA:
+        byte = ord(self._pack[pos])
+        pos += 1
+        base_offset = byte & 0x7f
+        while byte & 0x80:
+          byte = ord(self._pack[pos])
+          pos += 1
+          base_offset = ((base_offset + 1) << 7) | (byte & 0x7f)
+        chain.append((offset, pos, size))
+        offset -= base_offset
+      elif objtype == _REF_DELTA:
+        base_sha1 = self._pack[pos:pos + 20]
+        chain.append((offset, pos + 20, size))
+        offset = self.FindOffset(base_sha1)
+        assert offset is not None, 'Thin packs are not supported'
+      else:
+        data = self._Inflate(pos, size)
+        break
+
+    # Then apply the deltas back up to the requested object.
+    if chain:
+      self._AddToCache(offset, objtype, data)
+    for i, (offset, pos, size) in enumerate(reversed(chain)):
+      data = _ApplyDelta(data, self._Inflate(pos, size))
+      if i < len(chain) - 1:
+        self._AddToCache(offset, objtype, data)
+    return _PACK_OBJ_TYPE_NAMES[objtype], data
+
+  def _ReadHeader(self, offset):
+    byte = ord(self._pack[offset])
+    objtype = (byte >> 4) & 7
+    size = byte & 15
+    shift = 4
+    while byte & 0x80:
+      offset += 1
+      byte = ord(self._pack[offset])
+      size |= (byte & 0x7f) << shift
+      shift += 7
+    return objtype, size, offset + 1
+
+  def _Inflate(self, pos, size):
+    decompressor = zlib.decompressobj()
+    chunk_size = max(size + 64, 4096)
+    data = decompressor.decompress(self._pack[pos:pos + chunk_size])
+    while (len(data) < size and not decompressor.unused_data and
+           pos + chunk_size < len(self._pack)):
+      pos += chunk_size
+      data += decompressor.decompress(self._pack[pos:pos + chunk_size])
+    data += decompressor.flush()
+    assert(len(data) == size)
+    return data
+
+  def _AddToCache(self, offset, objtype, data):
+    if len(data) > self._max_cache_bytes / 4 or offset in self._cache:
+      return
+    self._cache[offset] = (objtype, data)
+    self._cache_bytes += len(data)
+    while self._cache_bytes > self._max_cache_bytes:
+      _, (_, evicted) = self._cache.popitem(last=False)
+      self._cache_bytes -= len(evicted)
+
+
+# objdir -> list of PackReader for the packs in objdir/pack/.
+_pack_readers = {}
+
+
+def _GetPackReaders(objdir, rescan=False):
+  readers = _pack_readers.get(objdir)
+  if readers is None or rescan:
+    known = {r.pack_path: r for r in readers or []}
+    packdir = os.path.join(objdir, 'pack')
+    readers = []
+    if os.path.isdir(packdir):
+      for fname in sorted(os.listdir(packdir)):
+        path = os.path.join(packdir, fname)
+        if fname.endswith('.pack') and os.path.exists(path[:-5] + '.idx'):
+          readers.append(known.get(path) or PackReader(path))
+    _pack_readers[objdir] = readers
+  return readers
+
+
+def _ReadPackedGitObj(sha1, objdir):
+  for reader in _GetPackReaders(objdir):
+    obj = reader.Read(sha1.raw)
+    if obj:
+      return obj
+  return None
+
+
+def _ReadPythonGitObj(sha1, objdir, objdir2 = ''):
+  """Looks up the object in the packs, then as loose object, of each objdir."""
   assert(isinstance(sha1, SHA1))
-  objpath = os.path.join(objdir, sha1.hex[0:2], sha1.hex[2:])
-  if not os.path.isfile(objpath):
-    objpath = os.path.join(objdir2, sha1.hex[0:2], sha1.hex[2:])
+  for rescan in (False, True):  # Packs might have appeared in the meantime.
+    for d in (objdir, objdir2) if objdir2 else (objdir,):
+      obj = _ReadPackedGitObj(sha1, d)
+      if obj:
+        return obj[0], len(obj[1]), obj[1]
+      objpath = os.path.join(d, sha1.hex[0:2], sha1.hex[2:])
+      if os.path.isfile(objpath):
+        return _ReadLooseGitObj(objpath)
+    if not rescan:
+      _GetPackReaders(objdir, rescan=True)
+      if objdir2:
+        _GetPackReaders(objdir2, rescan=True)
+  raise IOError('Git object %s not found in %s' % (
+      sha1.hex, ', '.join(x for x in (objdir, objdir2) if x)))
+
 
+def _ReadLooseGitObj(objpath):
   with open(objpath, 'rb') as fin:
     data = zlib.decompress(fin.read())
   headlen = data.index('\x00')
@@ -96,6 +490,173 @@ def ReadGitObj(sha1, objdir, objdir2 = ''):
   return objtype, objlen, payload
 
 
+class PythonObjectStore(object):
+  """Does all the object I/O in python.
+
+  Reads both loose objects and packs (see PackReader). Writes loose objects,
+  or packs after UsePackWriters().
+  """
+
+  def Read(self, sha1, objdir, objdir2 = ''):
+    return _ReadPythonGitObj(sha1, objdir, objdir2)
+
+  def Write(self, objtype, payload, objdir):
+    return _WritePythonGitObj(objtype, payload, objdir)
+
+  def WriteMany(self, objtype, payload, objdirs):
+    return _WritePythonGitObjMany(objtype, payload, objdirs)
+
+  def Close(self):
+    ClosePackWriters()
+
+
+class GitObjectStore(object):
+  """Does the object I/O through long-lived git processes.
+
+  Each process (e.g. each worker of a multiprocessing.Pool) spawns, for each
+  objdir, one `git cat-file --batch` for the reads and one `git fast-import`
+  for the writes, so that git's own pack access and delta compression are used.
+  fast-import cannot store arbitrary trees and commits byte-by-byte, hence those
+  go through the fallback store.
+  Blobs written by fast-import become readable only after a checkpoint, which
+  is issued on demand when a read misses.
+  """
+
+  def __init__(self, fallback=None):
+    self._fallback = fallback or PythonObjectStore()
+    self._pid = None
+    self._inherited = []
+
+  def _Init(self):
+    if self._pid == os.getpid():
+      return
+    if self._pid is not None:
+      # The processes spawned by the parent process are none of our business,
+      # but keep their pipes open: the parent still talks to them.
+      self._inherited.append((self._readers, self._writers))
+    self._pid = os.getpid()
+    self._readers = {}  # objdir -> git cat-file --batch
+    self._writers = {}  # objdir -> git fast-import
+    self._written = {}  # objdir -> set of raw SHA1s sent to fast-import
+    self._dirty = set()  # objdirs with writes not checkpointed yet.
+    self._git_dir = tempfile.mkdtemp(prefix='gitobjectstore-')
+    subprocess.check_call(['git', 'init', '-q', '--bare', self._git_dir])
+    multiprocessing.util.Finalize(None, self.Close, exitpriority=10)
+
+  def _Spawn(self, args, objdir):
+    env = dict(os.environ, GIT_DIR=self._git_dir, GIT_OBJECT_DIRECTORY=objdir)
+    return subprocess.Popen(['git'] + args, env=env, close_fds=True,
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+  def Read(self, sha1, objdir, objdir2 = ''):
+    assert(isinstance(sha1, SHA1))
+    self._Init()
+    for d in (objdir, objdir2) if objdir2 else (objdir,):
+      obj = self._CatFile(sha1, d)
+      if obj is None and d in self._dirty:
+        self._Checkpoint(d)
+        obj = self._CatFile(sha1, d)
+      if obj:
+        return obj
+    raise IOError('Git object %s not found in %s' % (
+        sha1.hex, ', '.join(x for x in (objdir, objdir2) if x)))
+
+  def _CatFile(self, sha1, objdir):
+    proc = self._readers.get(objdir)
+    if proc is None:
+      if not os.path.isdir(objdir):  # git would refuse to start.
+        return None
+      proc = self._readers[objdir] = self._Spawn(['cat-file', '--batch'],
+                                                 objdir)
+    proc.stdin.write(sha1.hex + '\n')
+    proc.stdin.flush()
+    header = proc.stdout.readline().split()
+    if header[1] == 'missing':
+      return None
+    objtype, objlen = header[1], int(header[2])
+    payload = proc.stdout.read(objlen + 1)[:-1]  # Strip the trailing \n.
+    return objtype, objlen, payload
+
+  def _Checkpoint(self, objdir):
+    proc = self._writers[objdir]
+    proc.stdin.write('checkpoint\nprogress checkpoint\n')
+    proc.stdin.flush()
+    line = proc.stdout.readline()
+    assert(line == 'progress checkpoint\n')
+    self._dirty.discard(objdir)
+
+  def Write(self, objtype, payload, objdir):
+    if objtype != 'blob':
+      return self._fallback.Write(objtype, payload, objdir)
+    self._Init()
+    hasher = hashlib.sha1('%s %d\x00' % (objtype, len(payload)))
+    hasher.update(payload)
+    sha1 = SHA1(hasher.digest())
+    written = self._written.setdefault(objdir, set())
+    if sha1.raw in written:
+      return sha1
+    proc = self._writers.get(objdir)
+    if proc is None:
+      Makedirs(objdir)
+      proc = self._writers[objdir] = self._Spawn(['fast-import', '--quiet'],
+                                                 objdir)
+    proc.stdin.write('blob\ndata %d\n' % len(payload))
+    proc.stdin.write(payload)
+    proc.stdin.write('\n')
+    written.add(sha1.raw)
+    self._dirty.add(objdir)
+    return sha1
+
+  def WriteMany(self, objtype, payload, objdirs):
+    if objtype != 'blob':
+      return self._fallback.WriteMany(objtype, payload, objdirs)
+    for objdir in objdirs:
+      sha1 = self.Write(objtype, payload, objdir)
+    return sha1
+
+  def Close(self):
+    if self._pid == os.getpid():
+      for args, procs in (('fast-import', self._writers),
+                          ('cat-file', self._readers)):
+        for objdir in sorted(procs):
+          proc = procs.pop(objdir)
+          proc.stdin.close()
+          if proc.wait() != 0:
+            raise subprocess.CalledProcessError(proc.returncode, args)
+      shutil.rmtree(self._git_dir, ignore_errors=True)
+      self._pid = None  # Start afresh if used again.
+    self._fallback.Close()
+
+
+OBJECT_STORES = {'python': PythonObjectStore, 'git': GitObjectStore}
+
+_object_store = PythonObjectStore()
+
+
+def SetObjectStore(store):
+  global _object_store
+  _object_store = store
+
+
+def CloseObjectStore():
+  """Flushes the pending writes (of the current process) to disk."""
+  _object_store.Close()
+
+
+def ReadGitObj(sha1, objdir, objdir2 = ''):
+  """Returns the tuple (objtype, objlen, payload)."""
+  return _object_store.Read(sha1, objdir, objdir2)
+
+
+def WriteGitObj(objtype, payload, objdir):
+  return _object_store.Write(objtype, payload, objdir)
+
+
+def WriteGitObjMany(objtype, payload, objdirs):
+  """Writes the same object into each of objdirs, returns its SHA1."""
+  return _object_store.WriteMany(objtype, payload, objdirs)
+
+
 def CopyGitBlobIntoFile(sha1, file_path, objdir):
   assert(isinstance(sha1, SHA1))
   objtype, _, data = ReadGitObj(sha1, objdir)
@@ -108,6 +669,11 @@ def ReadGitTree(sha1, objdir, objdir2 = ''):
   objtype, _, data = ReadGitObj(sha1, objdir, objdir2)
   #print 'READING ', sha1.hex, objtype, data
   assert(objtype == 'tree')
+  return ParseGitTree(data)
+
+
+def ParseGitTree(data):
+  """Returns the entries of the tree payload data (see ReadGitTree())."""
   s = 0
   entries = []
   while s < len(data):
@@ -128,10 +694,15 @@ def _GitTreeEntryGetSortKey(entry):
     return entry[1]
 
 
-def WriteGitTree(entries, objdir):
-  payload = ''
-  for e in sorted(entries, key=_GitTreeEntryGetSortKey):
-    payload += e[0] + ' ' + e[1] + '\x00' + e[2].raw
+def WriteGitTree(entries, objdir, presorted=False):
+  """Writes a tree of (mode, fname, sha1) entries, returns its SHA1.
+
+  presorted tells that the entries are already in git order (e.g. as returned by
+  ReadGitTree()), which spares sorting them.
+  """
+  if not presorted:
+    entries = sorted(entries, key=_GitTreeEntryGetSortKey)
+  payload = ''.join([e[0] + ' ' + e[1] + '\x00' + e[2].raw for e in entries])
   return WriteGitObj('tree', payload, objdir)
 
 
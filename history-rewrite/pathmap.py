@@ -0,0 +1,182 @@
+# -*- mode:python -*-
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Declarative mapping of the paths of the original tree onto the target repos.
+
+The rules are kept in a JSON file (see path_rules.json): a list of objects,
+tried in order, the first matching one wins. Each rule has:
+ - indent: the depth of the entry (0 for the entries of the root tree).
+ - path, parent, parentparent (optional): the path of the directory holding the
+   entry, or its last or second last component. Either a string or a list of
+   alternatives.
+ - names (optional): glob patterns (fnmatch, case sensitive) for the name of
+   the entry. Rules without names match any entry.
+ - map: [target, subpath] or [target, subpath, rename]. target can also be
+   'godeepr' (look into the entry), 'unk' or 'drop'. The strings can refer to
+   %(fname)s, %(fname_lower)s, %(parent)s and %(path)s.
+ - log (optional): a message printed on the log when the rule is applied.
+
+Entries matched by no rule are dropped (and logged).
+"""
+
+from __future__ import print_function
+
+import fnmatch
+import json
+import os
+
+
+_DEFAULT_MAP = ('drop', '')
+_DEFAULT_LOG = 'ERR: FIXME unprocessed L%(indent)d entry %(path)s/%(fname)s'
+
+
+def _Utf8(obj):
+  """Converts the (unicode) strings decoded by json to str, like the names in
+  the git trees."""
+  if isinstance(obj, unicode):
+    return obj.encode('utf-8')
+  if isinstance(obj, list):
+    return [_Utf8(x) for x in obj]
+  if isinstance(obj, dict):
+    return dict((_Utf8(k), _Utf8(v)) for k, v in obj.iteritems())
+  return obj
+
+
+def _Alternatives(value):
+  if value is None or isinstance(value, list):
+    return value
+  return [value]
+
+
+def _IsGlob(pattern):
+  return any(c in pattern for c in '*?[')
+
+
+class _Rule(object):
+
+  def __init__(self, spec):
+    self.indent = spec['indent']
+    self.path = _Alternatives(spec.get('path'))
+    self.parent = _Alternatives(spec.get('parent'))
+    self.parentparent = _Alternatives(spec.get('parentparent'))
+    self.names = _Alternatives(spec.get('names'))
+    self.map = tuple(spec['map'])
+    self.log = spec.get('log')
+    assert(len(self.map) in (2, 3))
+
+  def MatchesDir(self, path, parent, parentparent):
+    return ((self.path is None or path in self.path) and
+            (self.parent is None or parent in self.parent) and
+            (self.parentparent is None or parentparent in self.parentparent))
+
+  def MatchesName(self, fname):
+    if self.names is None:
+      return True
+    return any(fnmatch.fnmatchcase(fname, pattern) for pattern in self.names)
+
+  def Apply(self, indent, fname, path, parent):
+    """Returns the (mapping, log message) of the entry."""
+    values = {'indent': indent, 'fname': fname, 'fname_lower': fname.lower(),
+              'parent': parent, 'path': path}
+    resmap = tuple(s % values if '%' in s else s for s in self.map)
+    return resmap, (self.log % values if self.log else None)
+
+
+class _DirRules(object):
+  """The rules applying to the entries of one directory.
+
+  names caches the decision for each name seen so far. The rules with glob
+  patterns (or no names at all) are tried, in order, only for the names which
+  are not in the exact names of any rule.
+  """
+
+  def __init__(self, indent, path, rules):
+    self.indent = indent
+    self.path = path
+    _parent = os.path.split(path)
+    self.parent = _parent[1]
+    parentparent = os.path.split(_parent[0])[1]
+
+    self._rules = [r for r in rules
+                   if r.MatchesDir(path, self.parent, parentparent)]
+    self._exact = set()
+    self._patterns = []
+    for rule in self._rules:
+      if rule.names is not None and not any(_IsGlob(p) for p in rule.names):
+        self._exact.update(rule.names)
+      else:
+        self._patterns.append(rule)
+    self.names = {}
+
+  def Decide(self, fname):
+    # An exact name might be matched by a pattern of a preceding rule, hence
+    # the exact names are looked up in all the rules.
+    rules = self._rules if fname in self._exact else self._patterns
+    for rule in rules:
+      if rule.MatchesName(fname):
+        decision = rule.Apply(self.indent, fname, self.path, self.parent)
+        break
+    else:
+      decision = (_DEFAULT_MAP, _DEFAULT_LOG % {
+          'indent': self.indent, 'path': self.path, 'fname': fname})
+    self.names[fname] = decision
+    return decision
+
+
+class PathRules(object):
+  """The compiled mapping rules.
+
+  The rules matching each directory (indent, path) are selected once, the first
+  time one of its entries is looked up, and each decision is cached, so that
+  the entries of the subsequent revisions cost one dict lookup each.
+  """
+
+  def __init__(self, specs):
+    self._rules = {}
+    for spec in specs:
+      rule = _Rule(spec)
+      self._rules.setdefault(rule.indent, []).append(rule)
+    self._dirs = {}
+
+  def Map(self, indent, fname, path, log):
+    """Returns the mapping of the entry fname of the directory path."""
+    dir_rules = self._dirs.get((indent, path))
+    if dir_rules is None:
+      dir_rules = _DirRules(indent, path, self._rules.get(indent, []))
+      self._dirs[(indent, path)] = dir_rules
+    decision = dir_rules.names.get(fname)
+    if decision is None:
+      decision = dir_rules.Decide(fname)
+    resmap, message = decision
+    if message:
+      print(message, file=log)
+    return resmap
+
+
+def LoadPathRules(path):
+  with open(path) as f:
+    return PathRules(_Utf8(json.load(f)))
@@ -4,7 +4,7 @@ cd /mnt/d_scratch || exit 1
 
 echo "Update origin rev-list"
 cd origin
-git rev-list --format=%T --reverse git-svn >rev-list.txt || exit 1
+git rev-list --format=%T --reverse --topo-order git-svn >rev-list.txt || exit 1
 cd ..
 
 echo "Remove loose" && rm -Rf loose && mkdir loose
@@ -24,21 +24,27 @@ git config core.deltaBaseCacheLimit 2G
 
 date
 
-# Decompress all the packs (takes 1-2 hours)
-I=1;
-for P in $(find /mnt/d_scratch/origin -name '*.pack'); do
-  git unpack-objects < "$P" &
-  pids[${I}]=$!
-  I=$(( I + 1 ))
-done
-
-
-
-for pid in ${pids[*]}; do
-    echo "waiting for $pid"
-    wait $pid
-    echo $pid done
-done
+if [ "$UNPACK" == "1" ]; then
+  # Decompress all the packs (takes 1-2 hours)
+  I=1;
+  for P in $(find /mnt/d_scratch/origin -name '*.pack'); do
+    git unpack-objects < "$P" &
+    pids[${I}]=$!
+    I=$(( I + 1 ))
+  done
+
+  for pid in ${pids[*]}; do
+      echo "waiting for $pid"
+      wait $pid
+      echo $pid done
+  done
+else
+  # The rewrite reads packs directly (see gitutils.PackReader): just link them.
+  mkdir -p objects/pack
+  for P in $(find /mnt/d_scratch/origin -name '*.pack'); do
+    ln -f "$P" "${P%.pack}.idx" objects/pack/ || exit 1
+  done
+fi
 
 rsync -av /mnt/d_scratch/origin/.git/objects/[0-9a-f][0-9a-f] ./objects
 
@@ -6,7 +6,16 @@ mount -t tmpfs none /mnt/d_scratch/tmp -o size=40g,noatime,nr_inodes=0 || exit 1
 
 rm -vf log/*log;
 
-nice -n 15 python2.7 history-rewrite.py origin/rev-list.txt 2>&1 | tee rewrite.log
+# The state of each run lets the next one (INCREMENTAL=1) rewrite only the
+# new revisions, whose objects are then added to the converted repos.
+if [ "$INCREMENTAL" == "1" ]; then
+  REWRITE_ARGS="--state-dir state --incremental"
+else
+  rm -rf state
+  REWRITE_ARGS="--state-dir state"
+fi
+
+nice -n 15 python2.7 history-rewrite.py --packs $REWRITE_ARGS origin/rev-list.txt 2>&1 | tee rewrite.log
 
 if [ ${PIPESTATUS[0]} -ne 0 ]; then
   echo "Error exit";
@@ -21,18 +30,28 @@ while read REPO SHA; do
   echo $REPO $SHA;
   
   mkdir /mnt/d_scratch/tmp/$REPO/objects
-  mv /mnt/d_scratch/tmp/$REPO/[a-f0-9][a-f0-9] /mnt/d_scratch/tmp/$REPO/objects/
+  # --packs writes (almost) everything in $REPO/pack, loose objects are rare.
+  mv /mnt/d_scratch/tmp/$REPO/[a-f0-9][a-f0-9] /mnt/d_scratch/tmp/$REPO/objects/ 2>/dev/null
+  mv /mnt/d_scratch/tmp/$REPO/pack /mnt/d_scratch/tmp/$REPO/objects/
   
-  for F in config description  HEAD  hooks  info  refs; do
-    rsync -a loose/$F tmp/$REPO/$F || exit 1;
-  done;
+  if [ "$INCREMENTAL" == "1" ]; then
+    rsync -a /mnt/d_scratch/tmp/$REPO/objects/ /mnt/d_scratch/converted/$REPO/objects/ || exit 1;
+  else
+    for F in config description  HEAD  hooks  info  refs; do
+      rsync -a loose/$F tmp/$REPO/$F || exit 1;
+    done;
+  fi;
     
   if [ "$SHA1" == "None" ]; then
     echo "FIXME";
     continue;
   fi;
     
-  cd /mnt/d_scratch/tmp/$REPO
+  if [ "$INCREMENTAL" == "1" ]; then
+    cd /mnt/d_scratch/converted/$REPO
+  else
+    cd /mnt/d_scratch/tmp/$REPO
+  fi;
   echo "## git fsck"
   git fsck $SHA 2>&1 | tee fsck.log
   git update-ref refs/heads/master $SHA
@@ -51,10 +70,17 @@ echo "git packing"
 while read REPO SHA; do
   echo $REPO $SHA;
 
+  # Incremental runs already added their objects to the converted repos.
+  [ "$INCREMENTAL" == "1" ] && continue;
+
   cd /mnt/d_scratch/tmp/$REPO
 
-  git reflog expire --expire=now --all
-  nice -n 15 git repack -a -d || exit 1;
+  # The packs written by the rewrite are complete but not deltified. Set
+  # REPACK=1 to trade some time for a (much) smaller repo.
+  if [ "$REPACK" == "1" ]; then
+    git reflog expire --expire=now --all
+    nice -n 15 git repack -a -d || exit 1;
+  fi;
 
   rsync -avc --delete /mnt/d_scratch/tmp/$REPO/ /mnt/d_scratch/converted/$REPO/
 
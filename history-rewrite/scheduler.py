@@ -0,0 +1,134 @@
+# -*- mode:python -*-
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+A process pool which keeps neighbouring tasks on the same worker.
+"""
+
+import Queue
+import multiprocessing
+import traceback
+
+
+class RangePool(object):
+  """A pool of worker processes for long lists of similar tasks.
+
+  Each worker is given a contiguous range of the items, so that neighbouring
+  items (e.g. the trees of subsequent commits, which share most of their
+  sub-trees) are processed by the same worker and hit its local caches. A
+  worker which is done with its range steals the second half of the largest
+  range left to the others.
+
+  Only imap_unordered() is supported. The workers are forked by each call, so
+  neither the function nor the items need to be picklable.
+  """
+
+  def __init__(self, processes, initializer=None):
+    self._processes = processes
+    self._initializer = initializer
+    self._workers = []
+
+  def imap_unordered(self, func, items, chunksize=None):
+    """Yields func(item) for each of the items, in no particular order.
+
+    chunksize is accepted for compatibility with multiprocessing.Pool only.
+    """
+    count = len(items)
+    processes = max(1, min(self._processes, count))
+    # The [head, tail) range of the items left to each worker.
+    ranges = multiprocessing.RawArray('l', 2 * processes)
+    for i in xrange(processes):
+      ranges[2 * i] = count * i / processes
+      ranges[2 * i + 1] = count * (i + 1) / processes
+    lock = multiprocessing.Lock()
+    results = multiprocessing.Queue()
+    self._workers = [multiprocessing.Process(
+        target=self._Work, args=(i, func, items, ranges, lock, results))
+        for i in xrange(processes)]
+    for worker in self._workers:
+      worker.start()
+
+    done = 0
+    while done < count:
+      try:
+        status, value = results.get(True, 1)
+      except Queue.Empty:
+        if any(w.exitcode not in (None, 0) for w in self._workers):
+          self.terminate()
+          raise RuntimeError('A worker died unexpectedly')
+        continue
+      if status == 'error':
+        self.terminate()
+        raise RuntimeError('A worker failed:\n' + value)
+      done += 1
+      yield value
+
+  def close(self):
+    pass
+
+  def join(self):
+    for worker in self._workers:
+      worker.join()
+
+  def terminate(self):
+    for worker in self._workers:
+      worker.terminate()
+    self.join()
+
+  def _Work(self, index, func, items, ranges, lock, results):
+    if self._initializer:
+      self._initializer()
+    while True:
+      with lock:
+        item = _NextItem(index, ranges)
+      if item is None:
+        break
+      try:
+        results.put(('ok', func(items[item])))
+      except Exception:
+        results.put(('error', traceback.format_exc()))
+        break
+
+
+def _NextItem(index, ranges):
+  """Pops the next item of the range of worker index, stealing if needed.
+
+  Returns None if there are no items left. Must be called with the lock held.
+  """
+  head, tail = ranges[2 * index], ranges[2 * index + 1]
+  if head == tail:
+    victim = max(xrange(len(ranges) / 2),
+                 key=lambda i: ranges[2 * i + 1] - ranges[2 * i])
+    left = ranges[2 * victim + 1] - ranges[2 * victim]
+    if not left:
+      return None
+    # Take the second half of its items, or the last one.
+    tail = ranges[2 * victim + 1]
+    head = tail - (left + 1) / 2
+    ranges[2 * victim + 1] = head
+  ranges[2 * index] = head + 1
+  ranges[2 * index + 1] = tail
+  return head
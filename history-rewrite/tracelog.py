@@ -0,0 +1,153 @@
+# -*- mode:python -*-
+# Copyright (c) 2014 Primiano Tucci -- www.primianotucci.com
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# * The name of Primiano Tucci may not be used to endorse or promote products
+#   derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+"""
+Buffered logs of the workers of the history rewrite.
+
+Each worker keeps its log in memory and writes it out in batches, rather than
+once per line. The tracing of the entries of the tree walks, by far the most
+verbose part of the logs, is off unless asked for, either as text lines in the
+log or as binary records in <log>.trace, decoded offline with:
+
+  python tracelog.py <log>.trace
+"""
+
+from __future__ import print_function
+
+import multiprocessing.util
+import os
+import struct
+import sys
+
+
+# The trace modes.
+TRACE_OFF = 'off'
+TRACE_TEXT = 'text'
+TRACE_BINARY = 'binary'
+TRACE_MODES = [TRACE_OFF, TRACE_TEXT, TRACE_BINARY]
+
+_ENTRY_FORMAT = '>  %d %s %s %s/%s :%d => %s:%s\n'
+
+# indent, justmount, SHA1 and the lengths of mode, path, fname, target and
+# subpath, which follow the header.
+_ENTRY_HEADER = struct.Struct('<HB20sHHHHH')
+
+
+class _BatchWriter(object):
+  """Appends to a file, buffering up to buffer_size bytes in memory."""
+
+  def __init__(self, path, mode, buffer_size):
+    self._file = open(path, mode)
+    self._buffer_size = buffer_size
+    self._chunks = []
+    self._size = 0
+
+  def Write(self, data):
+    self._chunks.append(data)
+    self._size += len(data)
+    if self._size >= self._buffer_size:
+      self.Flush()
+
+  def Flush(self):
+    if self._chunks:
+      self._file.write(''.join(self._chunks))
+      self._chunks = []
+      self._size = 0
+    self._file.flush()
+
+  def Close(self):
+    self.Flush()
+    self._file.close()
+
+
+class TraceLog(object):
+  """The log of a worker, written out in batches of buffer_size bytes.
+
+  It is file-like (write() and flush()), messages are print()-ed into it as
+  usual. The entries of the tree walks go through Entry(), which callers should
+  skip unless trace is set, saving the formatting. The log is flushed when the
+  worker exits.
+  """
+
+  def __init__(self, path, trace_mode=TRACE_OFF, buffer_size=1 << 20):
+    assert(trace_mode in TRACE_MODES)
+    self.pid = os.getpid()
+    self.trace = trace_mode != TRACE_OFF
+    self._text = _BatchWriter(path, 'a', buffer_size)
+    self._binary = None
+    if trace_mode == TRACE_BINARY:
+      self._binary = _BatchWriter(path + '.trace', 'ab', buffer_size)
+    multiprocessing.util.Finalize(None, self.Close, exitpriority=10)
+
+  def write(self, data):
+    self._text.Write(data)
+
+  def flush(self):
+    self._text.Flush()
+    if self._binary:
+      self._binary.Flush()
+
+  def Entry(self, indent, mode, sha1, path, fname, justmount, resmap):
+    """Traces the entry fname (mode, sha1) of the directory path, mapped to
+    resmap."""
+    if self._binary:
+      target, subpath = resmap[0], resmap[1]
+      self._binary.Write(_ENTRY_HEADER.pack(
+          indent, justmount, sha1.raw, len(mode), len(path), len(fname),
+          len(target), len(subpath)) + mode + path + fname + target + subpath)
+    else:
+      self._text.Write(_ENTRY_FORMAT % (indent, mode, sha1.hex, path, fname,
+                                        justmount, resmap[0], resmap[1]))
+
+  def Close(self):
+    self._text.Close()
+    if self._binary:
+      self._binary.Close()
+
+
+def DecodeTrace(f, out):
+  """Writes the binary trace read from f as the lines of a text trace."""
+  data = f.read()
+  pos = 0
+  while pos + _ENTRY_HEADER.size <= len(data):
+    fields = _ENTRY_HEADER.unpack_from(data, pos)
+    indent, justmount, sha1_raw = fields[:3]
+    pos += _ENTRY_HEADER.size
+    strings = []
+    for size in fields[3:]:
+      strings.append(data[pos:pos + size])
+      pos += size
+    mode, path, fname, target, subpath = strings
+    out.write(_ENTRY_FORMAT % (indent, mode, sha1_raw.encode('hex'), path,
+                               fname, justmount, target, subpath))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) != 2:
+    print('usage: %s TRACE_FILE' % sys.argv[0], file=sys.stderr)
+    sys.exit(1)
+  with open(sys.argv[1], 'rb') as f:
+    DecodeTrace(f, sys.stdout)
@@ -25,19 +25,107 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import httplib
+import json
 import logging
 import multiprocessing
 import os
+import Queue
+import socket
 import sys
+import threading
 import time
 import zlib
 import optparse
 
+from collections import OrderedDict
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
 
 #TODO detect hung connections.
 
 _ZLIB_WINDOW_BUFFER_SIZE = 16 + zlib.MAX_WBITS
 
+# Uploads are compressed only if that shrinks them below this ratio.
+_MAX_UPLOAD_COMPRESSION_RATIO = 0.9
+
+# Bodies larger than this are decoded by a separate thread, so that
+# decompression and disk writes overlap with the network reads.
+_THREADED_DECODE_MIN_SIZE = 256 * 1024
+
+_HEAD_BATCH_SIZE = 64
+
+
+class Codec:
+  """A HTTP content-coding. See RegisterCodec()."""
+  def __init__(self, name, decoder_factory, compress_fn):
+    self.name = name
+    self.NewDecoder = decoder_factory  # () -> obj w/ .decompress() .flush()
+    self.Compress = compress_fn  # (str) -> str
+
+
+class _IdentityDecoder:
+  def decompress(self, data):
+    return data
+
+  def flush(self):
+    return ''
+
+
+class _DeflateDecoder:
+  """HTTP 'deflate' is zlib-wrapped, but some servers send raw deflate."""
+  def __init__(self):
+    self._zdec = None
+
+  def decompress(self, data):
+    if self._zdec is None:
+      self._zdec = zlib.decompressobj()
+      try:
+        return self._zdec.decompress(data)
+      except zlib.error:
+        self._zdec = zlib.decompressobj(-zlib.MAX_WBITS)
+    return self._zdec.decompress(data)
+
+  def flush(self):
+    return self._zdec.flush() if self._zdec else ''
+
+
+def _ZlibCompress(wbits):
+  def Compress(data):
+    zenc = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    return zenc.compress(data) + zenc.flush()
+  return Compress
+
+
+# Supported content-codings, in order of preference for Accept-Encoding.
+_CODECS = OrderedDict()
+
+
+def RegisterCodec(codec):
+  _CODECS[codec.name] = codec
+
+
+def GetCodec(name):
+  return _CODECS.get(name or 'identity')
+
+
+def _AcceptEncoding():
+  return ', '.join(n for n in _CODECS if n != 'identity')
+
+
+if zstandard:
+  RegisterCodec(Codec('zstd',
+                      lambda: zstandard.ZstdDecompressor().decompressobj(),
+                      lambda data: zstandard.ZstdCompressor().compress(data)))
+RegisterCodec(Codec('gzip',
+                    lambda: zlib.decompressobj(_ZLIB_WINDOW_BUFFER_SIZE),
+                    _ZlibCompress(_ZLIB_WINDOW_BUFFER_SIZE)))
+RegisterCodec(Codec('deflate', _DeflateDecoder, _ZlibCompress(zlib.MAX_WBITS)))
+RegisterCodec(Codec('identity', _IdentityDecoder, lambda data: data))
+
 
 class DownloadManyException(Exception):
   pass
@@ -49,15 +137,100 @@ class DownloadJobResult:
     self.local_path = local_path
     self.bytes_downloaded = 0
     self.bytes_written = 0
+    self.content_encoding = 'identity'
     self.error = 0  # TODO restructure
+    self.retries = 0
+    self.conn_id = None  # '<worker pid>.<connection serial>'.
+    self.conn_reused = False  # True if the request went on a keep-alive conn.
+    # Per-phase timings (seconds) of the last attempt. dns, connect and tls are
+    # 0 when the connection is reused.
+    self.time_dns = 0.0
+    self.time_connect = 0.0
+    self.time_tls = 0.0
+    self.time_ttfb = 0.0
+    self.time_transfer = 0.0
+    self.time_total = 0.0  # Includes retries and backoffs.
+
+
+class UploadJobResult:
+  def __init__(self, local_path, remote_path):
+    self.local_path = local_path
+    self.remote_path = remote_path
+    self.bytes_read = 0
+    self.bytes_uploaded = 0  # can be < read if the payload was gzipped.
+    self.content_encoding = None
+    self.error = 0
+    self.retries = 0
+    self.conn_id = None
+    self.time_total = 0.0
+
+
+def _TimedTcpConnect(conn):
+  """Connects conn.sock, accounting DNS resolution and TCP connect apart."""
+  t_start = time.time()
+  addrinfo = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+  t_resolved = time.time()
+  conn.time_dns += t_resolved - t_start
+  # Like socket.create_connection(): try each address until one connects.
+  err = None
+  try:
+    for af, socktype, proto, _, sa in addrinfo:
+      sock = None
+      try:
+        sock = socket.socket(af, socktype, proto)
+        if conn.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+          sock.settimeout(conn.timeout)
+        if conn.source_address:
+          sock.bind(conn.source_address)
+        sock.connect(sa)
+        conn.sock = sock
+        return
+      except socket.error as e:
+        err = e
+        if sock is not None:
+          sock.close()
+    if err is not None:
+      raise err
+    raise socket.error('getaddrinfo returns an empty list')
+  finally:
+    conn.time_connect += time.time() - t_resolved
+
+
+class _TimedHTTPConnection(httplib.HTTPConnection):
+  time_dns = time_connect = time_tls = 0.0
+
+  def connect(self):
+    _TimedTcpConnect(self)
+
+
+class _TimedHTTPSConnection(httplib.HTTPSConnection):
+  time_dns = time_connect = time_tls = 0.0
+
+  def connect(self):
+    _TimedTcpConnect(self)
+    t_start = time.time()
+    self.sock = self._context.wrap_socket(self.sock, server_hostname=self.host)
+    self.time_tls += time.time() - t_start
+
+
+def _PopConnectionTimings(conn, res):
+  res.time_dns, res.time_connect, res.time_tls = (
+      conn.time_dns, conn.time_connect, conn.time_tls)
+  conn.time_dns = conn.time_connect = conn.time_tls = 0.0
 
 
 def _GetCurrentWorker():
   return multiprocessing.current_process()
 
 
-def _InitWorker(host):
-  _GetCurrentWorker()._http_host = host
+def _InitWorker(host, extra_headers=None):
+  worker = _GetCurrentWorker()
+  worker._http_host = host
+  worker._http_conn_serial = 0
+  worker._http_extra_headers = extra_headers or {}
+  auth_token = os.getenv('GITCS_AUTH_TOKEN')
+  if auth_token:
+    worker._http_extra_headers['Authorization'] = 'Bearer ' + auth_token
   _ResetConnectionForCurrentWorker()
 
 
@@ -70,14 +243,15 @@ def _ResetConnectionForCurrentWorker():
 
   proxy = os.getenv('GITCS_PROXY')
   worker._http_req_prefix = ''
+  worker._http_conn_serial += 1
   if proxy:
-    worker._http_conn = httplib.HTTPSConnection(proxy)
+    worker._http_conn = _TimedHTTPSConnection(proxy)
     worker._http_req_prefix = worker._http_host
   elif worker._http_host.startswith('https://'):
-    worker._http_conn = httplib.HTTPSConnection(worker._http_host[8:])
+    worker._http_conn = _TimedHTTPSConnection(worker._http_host[8:])
   else:
     host = worker._http_host.replace('http://', '')
-    worker._http_conn = httplib.HTTPConnection(host)
+    worker._http_conn = _TimedHTTPConnection(host)
 
 
 # TODO Wrap and return error as part of the job result
@@ -86,11 +260,20 @@ def _DownloadWorkerJob(args):
   remote_path, local_path = args
   res = DownloadJobResult(remote_path, local_path)
   worker = _GetCurrentWorker()
-  for retry_backoff_sec in [0.1, 0]:  ###################################### [0.5, 2, 5]
+  t_job_start = time.time()
+  for attempt, retry_backoff_sec in enumerate([0.1, 0]):  ################ [0.5, 2, 5]
+    res.retries = attempt
     conn = worker._http_conn
+    res.conn_id = '%d.%d' % (worker.pid, worker._http_conn_serial)
+    res.conn_reused = conn.sock is not None
     conn.request('GET', worker._http_req_prefix + remote_path,
-        headers={'Connection': 'keep-alive', 'Accept-Encoding': 'gzip'})
+        headers={'Connection': 'keep-alive',
+                 'Accept-Encoding': _AcceptEncoding()})
+    t_sent = time.time()
     resp = conn.getresponse(buffering=True)
+    t_headers = time.time()
+    _PopConnectionTimings(conn, res)
+    res.time_ttfb = t_headers - t_sent
 
     # Retry logic.
     if resp.status != httplib.OK:
@@ -103,31 +286,94 @@ def _DownloadWorkerJob(args):
       time.sleep(retry_backoff_sec)
       _ResetConnectionForCurrentWorker()
       continue
+    res.error = 0
 
-    zdec = None
-    if resp.getheader('content-encoding') == 'gzip':
-      zdec = zlib.decompressobj(_ZLIB_WINDOW_BUFFER_SIZE)
+    res.content_encoding = resp.getheader('content-encoding') or 'identity'
+    # Unknown codings (never advertised in Accept-Encoding) are stored as-is.
+    codec = GetCodec(res.content_encoding) or GetCodec('identity')
+    threaded = (resp.length or 0) > _THREADED_DECODE_MIN_SIZE
     with open(local_path, 'wb') as local_fd:
-      while True:
-        data = resp.read(IO_BLOCK_SIZE)
-        data_len = len(data)
-        if data_len:
-          res.bytes_downloaded += data_len
-          if zdec:
-            dec_data = zdec.decompress(data)
-          else:
-            dec_data = data
-          res.bytes_written += len(dec_data)
-          local_fd.write(dec_data)
-        if data_len < IO_BLOCK_SIZE:
-          if zdec:
-            dec_data = zdec.flush()
-            local_fd.write(dec_data)
-            res.bytes_written += len(dec_data)
-          break
+      decoder = _StreamDecoder(codec.NewDecoder(), local_fd)
+      if threaded:
+        decoder.start()
+      try:
+        while True:
+          data = resp.read(IO_BLOCK_SIZE)
+          data_len = len(data)
+          if data_len:
+            res.bytes_downloaded += data_len
+            if threaded:
+              decoder.Feed(data)
+            else:
+              decoder.Decode(data)
+          if data_len < IO_BLOCK_SIZE:
+            break
+        if threaded:
+          decoder.Finish()
+        else:
+          decoder.Decode(None)
+      finally:
+        # Don't leave the thread behind (writing to local_fd) on read errors.
+        if threaded:
+          decoder.Stop()
+      res.bytes_written = decoder.bytes_written
+    res.time_transfer = time.time() - t_headers
+    break
+  res.time_total = time.time() - t_job_start
   return res
 
 
+class _StreamDecoder(threading.Thread):
+  """Decodes a response body and writes it out, optionally in a thread.
+
+  Decode() works synchronously. Alternatively, after start(), chunks are passed
+  through Feed() and decoded by the thread, while the caller keeps reading from
+  the socket (zlib and file writes release the GIL). A None chunk ends the
+  stream.
+  """
+  def __init__(self, decoder, local_fd):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.bytes_written = 0
+    self._decoder = decoder
+    self._local_fd = local_fd
+    self._queue = Queue.Queue(maxsize=64)
+    self._exc_info = None
+    self._stopped = False
+
+  def Decode(self, data):
+    dec_data = self._decoder.decompress(data) if data is not None else (
+        self._decoder.flush())
+    self.bytes_written += len(dec_data)
+    self._local_fd.write(dec_data)
+
+  def Feed(self, data):
+    self._queue.put(data)
+
+  def Finish(self):
+    self.Stop()
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+  def Stop(self):
+    """Ends the stream and waits for the thread, without raising its errors."""
+    if not self._stopped:
+      self._stopped = True
+      self._queue.put(None)
+      self.join()
+
+  def run(self):
+    while True:
+      data = self._queue.get()
+      if not self._exc_info:
+        try:
+          self.Decode(data)
+        except Exception:
+          self._exc_info = sys.exc_info()  # Keep draining, re-raise in Finish.
+      if data is None:
+        break
+
+
 def DownloadMany(host, iterable, jobs=8):
   pool = multiprocessing.Pool(jobs, initializer=_InitWorker, initargs=[host])
   for job_result in pool.imap_unordered(_DownloadWorkerJob, iterable):
@@ -136,6 +382,262 @@ def DownloadMany(host, iterable, jobs=8):
   pool.join()
 
 
+def _CompressIfWorthIt(data, encoding):
+  if not encoding or encoding == 'identity':
+    return data, None
+  zdata = GetCodec(encoding).Compress(data)
+  if len(zdata) < len(data) * _MAX_UPLOAD_COMPRESSION_RATIO:
+    return zdata, encoding
+  return data, None
+
+
+def _UploadWorkerJob(args):
+  local_path, remote_path, encoding = args
+  res = UploadJobResult(local_path, remote_path)
+  worker = _GetCurrentWorker()
+  t_job_start = time.time()
+  with open(local_path, 'rb') as fd:
+    data = fd.read()
+  res.bytes_read = len(data)
+  data, res.content_encoding = _CompressIfWorthIt(data, encoding)
+  res.bytes_uploaded = len(data)
+  headers = {'Connection': 'keep-alive',
+             'Content-Type': 'application/octet-stream',
+             'Content-Length': str(len(data))}
+  headers.update(worker._http_extra_headers)
+  if res.content_encoding:
+    headers['Content-Encoding'] = res.content_encoding
+  for attempt, retry_backoff_sec in enumerate([0.5, 2, 0]):
+    res.retries = attempt
+    res.conn_id = '%d.%d' % (worker.pid, worker._http_conn_serial)
+    try:
+      conn = worker._http_conn
+      conn.request('PUT', worker._http_req_prefix + remote_path, data, headers)
+      resp = conn.getresponse()
+      resp.read()  # Unblock for the next request.
+      res.error = 0 if resp.status in (httplib.OK, httplib.CREATED) else (
+          resp.status)
+    except (httplib.HTTPException, socket.error) as e:
+      res.error = str(e) or e.__class__.__name__
+      resp = None
+    if not res.error:
+      break
+    if resp and 400 <= resp.status < 500 and resp.status not in (408, 429):
+      break  # Client errors (auth, quota, ...) won't get better by retrying.
+    time.sleep(retry_backoff_sec)
+    _ResetConnectionForCurrentWorker()
+  res.time_total = time.time() - t_job_start
+  return res
+
+
+def _HeadWorkerJob(remote_paths):
+  """Returns a list of (remote_path, HTTP status) for a batch of paths."""
+  worker = _GetCurrentWorker()
+  headers = {'Connection': 'keep-alive'}
+  headers.update(worker._http_extra_headers)
+  results = []
+  for remote_path in remote_paths:
+    status = None
+    for retry_backoff_sec in [0.5, 0]:
+      try:
+        conn = worker._http_conn
+        conn.request('HEAD', worker._http_req_prefix + remote_path,
+                     headers=headers)
+        resp = conn.getresponse()
+        resp.read()  # Unblock for the next request.
+        status = resp.status
+      except (httplib.HTTPException, socket.error):
+        status = -1
+      if status in (httplib.OK, httplib.NOT_FOUND):
+        break
+      time.sleep(retry_backoff_sec)
+      _ResetConnectionForCurrentWorker()
+    results.append((remote_path, status))
+  return results
+
+
+def _Batches(iterable, batch_size):
+  batch = []
+  for item in iterable:
+    batch.append(item)
+    if len(batch) == batch_size:
+      yield batch
+      batch = []
+  if batch:
+    yield batch
+
+
+def UploadMany(host, iterable, jobs=8, headers=None, encoding='gzip'):
+  """Uploads (PUT) each (/local/path, /remote/path) of the iterable.
+
+  Files are compressed on the fly with the |encoding| codec, when worth it.
+  """
+  if not GetCodec(encoding):
+    raise ValueError('Unsupported content encoding: %s' % encoding)
+  pool = multiprocessing.Pool(jobs, initializer=_InitWorker,
+                              initargs=[host, headers])
+  jobs_iter = ((local_path, remote_path, encoding)
+               for local_path, remote_path in iterable)
+  for job_result in pool.imap_unordered(_UploadWorkerJob, jobs_iter):
+    yield job_result
+  pool.close()
+  pool.join()
+
+
+def ExistMany(host, iterable, jobs=8):
+  """Yields (remote_path, HTTP status) tuples, one HEAD request per path.
+
+  Paths are dispatched to the workers in batches of _HEAD_BATCH_SIZE, which are
+  then issued back to back over the keep-alive connection of each worker.
+  """
+  pool = multiprocessing.Pool(jobs, initializer=_InitWorker, initargs=[host])
+  batches = _Batches(iterable, _HEAD_BATCH_SIZE)
+  for batch_results in pool.imap_unordered(_HeadWorkerJob, batches):
+    for job_result in batch_results:
+      yield job_result
+  pool.close()
+  pool.join()
+
+
+class CodecStats:
+  """Keeps the per content-coding totals of a stream of DownloadJobResult."""
+  def __init__(self):
+    self.codecs = {}  # encoding -> [files, bytes_downloaded, bytes_written].
+
+  def Add(self, res):
+    totals = self.codecs.setdefault(res.content_encoding, [0, 0, 0])
+    totals[0] += 1
+    totals[1] += res.bytes_downloaded
+    totals[2] += res.bytes_written
+
+  def Summary(self):
+    lines = []
+    for encoding, (files, downloaded, written) in sorted(
+        self.codecs.iteritems()):
+      lines.append('%-10s %8d files %10.2f MB -> %10.2f MB  ratio %5.2f' % (
+          encoding, files, downloaded / 1048576.0, written / 1048576.0,
+          1.0 * written / max(downloaded, 1)))
+    return '\n'.join(lines)
+
+
+class MetricsSink:
+  """Consumes DownloadJobResult(s) and exports per-request metrics.
+
+  This base sink discards them: subclasses override Add() and Close().
+  """
+  def Add(self, res):
+    pass
+
+  def Close(self):
+    pass
+
+
+class JsonLinesMetricsSink(MetricsSink):
+  """Appends one JSON object per request (all the DownloadJobResult fields)."""
+  def __init__(self, path):
+    self._fd = open(path, 'a')
+
+  def Add(self, res):
+    record = dict(vars(res), timestamp=time.time())
+    self._fd.write(json.dumps(record, sort_keys=True) + '\n')
+
+  def Close(self):
+    self._fd.close()
+
+
+class PrometheusMetricsSink(MetricsSink):
+  """Periodically (re)writes a node-exporter compatible textfile."""
+  PHASES = ('dns', 'connect', 'tls', 'ttfb', 'transfer', 'total')
+  BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+  MIN_WRITE_INTERVAL_S = 10
+
+  def __init__(self, path):
+    self._path = path
+    self._last_write_time = 0
+    self._buckets = dict((p, [0] * len(self.BUCKETS)) for p in self.PHASES)
+    self._sums = dict((p, 0.0) for p in self.PHASES)
+    self._count = 0
+    self._errors = 0
+    self._retries = 0
+    self._reused = 0
+    self._bytes_downloaded = 0
+    self._bytes_written = 0
+    self._conns = {}  # conn_id -> [bytes_downloaded, seconds on the wire].
+    self._codec_stats = CodecStats()
+
+  def Add(self, res):
+    self._count += 1
+    self._errors += 1 if res.error else 0
+    self._retries += res.retries
+    self._reused += 1 if res.conn_reused else 0
+    self._bytes_downloaded += res.bytes_downloaded
+    self._bytes_written += res.bytes_written
+    self._codec_stats.Add(res)
+    for phase in self.PHASES:
+      value = getattr(res, 'time_' + phase)
+      self._sums[phase] += value
+      buckets = self._buckets[phase]
+      for i, upper_bound in enumerate(self.BUCKETS):
+        if value <= upper_bound:
+          buckets[i] += 1
+    conn = self._conns.setdefault(res.conn_id, [0, 0.0])
+    conn[0] += res.bytes_downloaded
+    conn[1] += res.time_ttfb + res.time_transfer
+    now = time.time()
+    if now - self._last_write_time > self.MIN_WRITE_INTERVAL_S:
+      self._last_write_time = now
+      self._Write()
+
+  def Close(self):
+    self._Write()
+
+  def _Write(self):
+    lines = ['# HELP wjet_request_phase_seconds Latency of each request phase.',
+             '# TYPE wjet_request_phase_seconds histogram']
+    for phase in self.PHASES:
+      for upper_bound, count in zip(self.BUCKETS, self._buckets[phase]):
+        lines.append('wjet_request_phase_seconds_bucket{phase="%s",le="%s"} %d'
+                     % (phase, upper_bound, count))
+      lines.append('wjet_request_phase_seconds_bucket{phase="%s",le="+Inf"} %d'
+                   % (phase, self._count))
+      lines.append('wjet_request_phase_seconds_sum{phase="%s"} %f' % (
+          phase, self._sums[phase]))
+      lines.append('wjet_request_phase_seconds_count{phase="%s"} %d' % (
+          phase, self._count))
+    for name, value in (('requests', self._count),
+                        ('errors', self._errors),
+                        ('retries', self._retries),
+                        ('reused_connection_requests', self._reused),
+                        ('bytes_downloaded', self._bytes_downloaded),
+                        ('bytes_written', self._bytes_written)):
+      lines.append('# TYPE wjet_%s_total counter' % name)
+      lines.append('wjet_%s_total %d' % (name, value))
+    for name, index in (('files', 0), ('bytes_downloaded', 1),
+                        ('bytes_written', 2)):
+      lines.append('# TYPE wjet_codec_%s_total counter' % name)
+      for encoding, totals in sorted(self._codec_stats.codecs.iteritems()):
+        lines.append('wjet_codec_%s_total{codec="%s"} %d' % (
+            name, encoding, totals[index]))
+    lines.append('# TYPE wjet_connection_throughput_bytes_per_second gauge')
+    for conn_id, (conn_bytes, conn_secs) in sorted(self._conns.iteritems()):
+      lines.append('wjet_connection_throughput_bytes_per_second{conn="%s"} %f'
+                   % (conn_id, conn_bytes / max(conn_secs, 0.001)))
+    with open(self._path + '.tmp', 'w') as fd:
+      fd.write('\n'.join(lines) + '\n')
+    os.rename(self._path + '.tmp', self._path)
+
+
+def OpenMetricsSink(path, fmt=None):
+  """Returns a MetricsSink for |fmt| ('jsonl' or 'prom', guessed from path)."""
+  if fmt is None:
+    fmt = 'prom' if path.endswith('.prom') else 'jsonl'
+  if fmt == 'prom':
+    return PrometheusMetricsSink(path)
+  elif fmt == 'jsonl':
+    return JsonLinesMetricsSink(path)
+  raise ValueError('Unknown metrics format: %s' % fmt)
+
+
 def _StdinReader():
   while True:
     line = sys.stdin.readline().rstrip('\r\n')
@@ -161,17 +663,26 @@ def main():
 
   parser = optparse.OptionParser(usage='%prog [options] host')
   parser.add_option('-j', '--jobs', type='int', default=None)
+  parser.add_option('--metrics-file',
+                    help='Export per-request metrics to this file')
+  parser.add_option('--metrics-format', choices=('jsonl', 'prom'),
+                    help='jsonl (one record per request) or prom (Prometheus '
+                         'textfile). Default: guessed from --metrics-file')
   options, args = parser.parse_args()
   if len(args) != 1:
     parser.print_usage()
     return 1
   host = args[0]
+  metrics = None
+  if options.metrics_file:
+    metrics = OpenMetricsSink(options.metrics_file, options.metrics_format)
 
   completed = 0
   total_bytes_downloaded = 0
   total_bytes_written = 0
   errors = 0
   start_time = time.time()
+  codec_stats = CodecStats()
 
   print 'Reading /remote/path /local/path tuples from stdin'
   print ''
@@ -179,8 +690,11 @@ def main():
   print '-------------+------------+--------------+---------+--------'
   last_stats_update = 0
   for res in DownloadMany(host, _StdinReader(), options.jobs):
+    if metrics:
+      metrics.Add(res)
     total_bytes_downloaded += res.bytes_downloaded
     total_bytes_written += res.bytes_written
+    codec_stats.Add(res)
     if not res.error:
       completed += 1
     else:
@@ -197,6 +711,9 @@ def main():
                                                     compr_ratio,
                                                     errors)
 
+  print '\n' + codec_stats.Summary()
+  if metrics:
+    metrics.Close()
   return 0 if not errors else 1
 
 